@@ -88,7 +88,7 @@ export const api = {
         method: "POST",
       }),
     downloadPDF: (studyId: number) =>
-      apiRequest<{ pdf: string; filename: string }>(`/studies/${studyId}/pdf`),
+      apiRequest<{ pdf: string; filename: string }>(`/studies/${studyId}/pdf?format=base64`),
     getMessages: (studyId: number) =>
       apiRequest<any[]>(`/studies/${studyId}/messages`),
     sendMessage: (studyId: number, message: string) =>
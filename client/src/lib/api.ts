@@ -71,8 +71,16 @@ export const api = {
       apiRequest<{ success: boolean; analysisResult: string }>(`/studies/${studyId}/analyze`, {
         method: "POST",
       }),
-    downloadPDF: (studyId: number) =>
-      apiRequest<{ pdf: string; filename: string }>(`/studies/${studyId}/pdf`),
+    downloadPDF: async (studyId: number) => {
+      const response = await fetch(`${API_BASE}/studies/${studyId}/pdf`, {
+        credentials: "include",
+      });
+      if (!response.ok) {
+        const error = await response.json().catch(() => ({ detail: response.statusText }));
+        throw new Error(error.detail || `HTTP error! status: ${response.status}`);
+      }
+      return response.blob();
+    },
     getMessages: (studyId: number) =>
       apiRequest<any[]>(`/studies/${studyId}/messages`),
     sendMessage: (studyId: number, message: string) =>
@@ -94,22 +94,13 @@ export default function StudyView() {
 
     setIsDownloading(true);
     try {
-      const result = await downloadPDFMutation.mutateAsync();
-
-      // Convert base64 to blob
-      const byteCharacters = atob(result.pdf);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-      }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: "application/pdf" });
+      const blob = await downloadPDFMutation.mutateAsync();
 
       // Download
       const url = URL.createObjectURL(blob);
       const a = document.createElement("a");
       a.href = url;
-      a.download = result.filename;
+      a.download = `${study?.title ?? "study"}.pdf`;
       document.body.appendChild(a);
       a.click();
       document.body.removeChild(a);
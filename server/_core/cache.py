@@ -0,0 +1,47 @@
+"""Small in-process TTL + LRU cache"""
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """Bounded LRU mapping whose entries expire after `ttl` seconds
+    
+    Not thread-safe: meant for use from the event loop thread only.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[V, float]]" = OrderedDict()
+    
+    def get(self, key: Hashable) -> Optional[V]:
+        """Return the cached value, or None if missing or expired"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+    
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """Store a value; `ttl` overrides the default lifetime (capped by it)"""
+        lifetime = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (value, time.monotonic() + lifetime)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+    
+    def clear(self) -> None:
+        self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
@@ -2,15 +2,36 @@
 from typing import Dict, Optional
 from fastapi import Request
 
-LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+LOCAL_HOSTS = frozenset({"localhost", "127.0.0.1", "::1"})
+
+# Важно: не указываем domain для localhost/IP, чтобы cookie работал
+# SameSite=Lax работает для HTTP запросов с IP адресами
+# Shared read-only: callers only unpack these into set_cookie/delete_cookie
+_LOCAL_COOKIE_OPTS = {
+    "httponly": True,
+    "path": "/",
+    "samesite": "lax",
+    "secure": False,
+}
+
+_REMOTE_COOKIE_OPTS_BASE = {
+    "httponly": True,
+    "path": "/",
+    "samesite": "none",
+}
 
 
 def is_ip_address(host: str) -> bool:
     """Check if host is an IP address"""
-    # Basic IPv4 check and IPv6 presence detection
-    if len(host.split(".")) == 4 and all(part.isdigit() for part in host.split(".")):
+    # IPv6 presence detection
+    if ":" in host:
         return True
-    return ":" in host
+    # Basic IPv4 check: a dotted quad is at most 15 chars ("255.255.255.255")
+    if len(host) > 15 or host.count(".") != 3:
+        return False
+    if host[0] == "." or host[-1] == "." or ".." in host:
+        return False
+    return host.replace(".", "").isdigit()
 
 
 def is_secure_request(request: Request) -> bool:
@@ -22,6 +43,12 @@ def is_secure_request(request: Request) -> bool:
     if not forwarded_proto:
         return False
     
+    # Common case: a single proxy sets one value
+    if forwarded_proto == "https":
+        return True
+    if "," not in forwarded_proto:
+        return forwarded_proto.strip().lower() == "https"
+    
     proto_list = forwarded_proto.split(",")
     return any(proto.strip().lower() == "https" for proto in proto_list)
 
@@ -29,25 +56,10 @@ def is_secure_request(request: Request) -> bool:
 def get_session_cookie_options(request: Request) -> Dict[str, any]:
     """Get session cookie options based on request"""
     host = request.headers.get("host", "").split(":")[0]
-    is_local = host in LOCAL_HOSTS or host == "::1" or is_ip_address(host)
     
     # For localhost and IP addresses, use lax samesite without secure
-    # Важно: не указываем domain для localhost/IP, чтобы cookie работал
-    # SameSite=Lax работает для HTTP запросов с IP адресами
-    if is_local or is_ip_address(host):
-        return {
-            "httponly": True,
-            "path": "/",
-            "samesite": "lax",
-            "secure": False,
-            # Не указываем domain для localhost/IP - это позволит cookie работать
-        }
-    else:
-        # For domain names, use none with secure (for cross-site requests)
-        return {
-            "httponly": True,
-            "path": "/",
-            "samesite": "none",
-            "secure": is_secure_request(request),
-        }
-
+    if host in LOCAL_HOSTS or is_ip_address(host):
+        return _LOCAL_COOKIE_OPTS
+    
+    # For domain names, use none with secure (for cross-site requests)
+    return {**_REMOTE_COOKIE_OPTS_BASE, "secure": is_secure_request(request)}
@@ -1,45 +1,58 @@
 """FastAPI dependencies for authentication and authorization"""
+import logging
 from typing import Optional, Dict, Any
 from fastapi import Depends, HTTPException, status, Request
 from server._core.sdk import sdk
 from server._core.const import UNAUTHED_ERR_MSG, NOT_ADMIN_ERR_MSG, COOKIE_NAME
 from server._core.simple_auth import get_user_by_open_id
 
+logger = logging.getLogger(__name__)
+
+_UNRESOLVED = object()
 
 async def get_current_user(request: Request) -> Optional[Dict[str, Any]]:
     """Get current user from request (optional, for public endpoints) - простая аутентификация"""
+    # Resolved once per request, then reused by require_user/require_admin
+    user = getattr(request.state, "current_user", _UNRESOLVED)
+    if user is _UNRESOLVED:
+        user = await _resolve_current_user(request)
+        request.state.current_user = user
+    return user
+
+
+async def _resolve_current_user(request: Request) -> Optional[Dict[str, Any]]:
+    """Resolve the user behind the session cookie"""
     try:
         # Простая аутентификация через сессионные cookies
         cookies = request.cookies
         session_cookie = cookies.get(COOKIE_NAME)
         
-        print(f"[Auth] get_current_user called for {request.url.path}")
-        print(f"[Auth] Cookies received: {list(cookies.keys())}")
-        print(f"[Auth] Session cookie present: {session_cookie is not None}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[Auth] get_current_user called for %s, cookies: %s, session cookie present: %s",
+                request.url.path, list(cookies.keys()), session_cookie is not None
+            )
         
         if session_cookie:
-            # Verify session and get user
-            session = await sdk.verify_session(session_cookie)
+            # Verify session (cached in the sdk up to the token's exp) and get user
+            session = await sdk.verify_request_session(request)
             if session:
-                print(f"[Auth] Session verified, openId: {session.openId}")
                 user = get_user_by_open_id(session.openId)
                 if user:
-                    print(f"[Auth] User found: {user.get('email')}")
+                    logger.debug("[Auth] User found for openId: %s", session.openId)
                     return user
                 else:
-                    print(f"[Auth] User not found for openId: {session.openId}")
+                    logger.debug("[Auth] User not found for openId: %s", session.openId)
             else:
-                print(f"[Auth] Session verification failed")
+                logger.debug("[Auth] Session verification failed")
         else:
-            print(f"[Auth] No session cookie found")
+            logger.debug("[Auth] No session cookie found")
         
         return None
     except HTTPException:
         return None
     except Exception as e:
-        print(f"[Auth] Error in get_current_user: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[Auth] Error in get_current_user: %s", e)
         return None
 
 
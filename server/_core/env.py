@@ -4,43 +4,18 @@ from typing import Optional
 
 
 class ENV:
-    """Environment variables configuration"""
-    
-    @staticmethod
-    def _get_env(key: str, default: str = "") -> str:
-        return os.getenv(key, default)
-    
-    @property
-    def app_id(self) -> str:
-        return self._get_env("VITE_APP_ID")
-    
-    @property
-    def cookie_secret(self) -> str:
-        return self._get_env("JWT_SECRET")
-    
-    @property
-    def database_url(self) -> str:
-        return self._get_env("DATABASE_URL")
-    
-    @property
-    def oauth_server_url(self) -> str:
-        return self._get_env("OAUTH_SERVER_URL")
-    
-    @property
-    def owner_open_id(self) -> str:
-        return self._get_env("OWNER_OPEN_ID")
-    
-    @property
-    def is_production(self) -> bool:
-        return os.getenv("NODE_ENV", "").lower() == "production"
-    
-    @property
-    def forge_api_url(self) -> str:
-        return self._get_env("BUILT_IN_FORGE_API_URL", "https://openrouter.ai/api")
-    
-    @property
-    def forge_api_key(self) -> str:
-        return self._get_env(
+    """Environment variables configuration (read once at import, cached as attributes)"""
+
+    def __init__(self):
+        environ = os.environ
+        self.app_id: str = environ.get("VITE_APP_ID", "")
+        self.cookie_secret: str = environ.get("JWT_SECRET", "")
+        self.database_url: str = environ.get("DATABASE_URL", "")
+        self.oauth_server_url: str = environ.get("OAUTH_SERVER_URL", "")
+        self.owner_open_id: str = environ.get("OWNER_OPEN_ID", "")
+        self.is_production: bool = environ.get("NODE_ENV", "").lower() == "production"
+        self.forge_api_url: str = environ.get("BUILT_IN_FORGE_API_URL", "https://openrouter.ai/api")
+        self.forge_api_key: str = environ.get(
             "BUILT_IN_FORGE_API_KEY",
             "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"
         )
@@ -48,4 +23,3 @@ class ENV:
 
 # Global instance
 env = ENV()
-
@@ -0,0 +1,15 @@
+"""Shared HTTP client for outbound API calls"""
+import httpx
+
+# One pooled client for the whole process (LLM, notification, OAuth, storage):
+# keeps TLS sessions and connections alive between calls
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0),
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+)
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client (called on app shutdown)"""
+    await http_client.aclose()
@@ -1,53 +1,78 @@
 """LLM API integration"""
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Iterator, Literal, Optional, TypedDict, Union
+import orjson
 from server._core.env import env
+from server._core.http import http_client
 
 # Type definitions
 Role = str  # "system" | "user" | "assistant" | "tool" | "function"
 
-TextContent = Dict[str, str]  # {"type": "text", "text": "..."}
-ImageContent = Dict[str, Any]  # {"type": "image_url", "image_url": {...}}
-FileContent = Dict[str, Any]  # {"type": "file_url", "file_url": {...}}
+# Content parts are plain dicts at runtime; TypedDicts only describe their shape
+class TextContent(TypedDict):
+    type: Literal["text"]
+    text: str
 
-MessageContent = Union[str, TextContent, ImageContent, FileContent, List[Union[TextContent, ImageContent, FileContent]]]
+
+class ImageContent(TypedDict):
+    type: Literal["image_url"]
+    image_url: Dict[str, Any]  # {"url": ..., "detail": ...}
+
+
+class FileContent(TypedDict):
+    type: Literal["file_url"]
+    file_url: Dict[str, Any]
+
+
+ContentPart = Union[TextContent, ImageContent, FileContent]
+
+MessageContent = Union[str, ContentPart, List[Union[str, ContentPart]]]
 
 Message = Dict[str, Any]  # {"role": Role, "content": MessageContent, ...}
 
-Tool = Dict[str, Any]  # {"type": "function", "function": {...}}
 
-InvokeResult = Dict[str, Any]
+class NormalizedMessage(TypedDict, total=False):
+    role: Role
+    content: Union[str, List[ContentPart]]
+    name: str
+    tool_call_id: str
 
+Tool = Dict[str, Any]  # {"type": "function", "function": {...}}
 
-def _ensure_array(value: MessageContent) -> List[Union[TextContent, ImageContent, FileContent]]:
-    """Ensure content is an array"""
-    if isinstance(value, str):
-        return [{"type": "text", "text": value}]
-    if isinstance(value, list):
-        return value
-    return [value]
+InvokeResult = Dict[str, Any]
 
 
-def _normalize_content_part(part: MessageContent) -> Union[TextContent, ImageContent, FileContent]:
-    """Normalize content part"""
-    if isinstance(part, str):
-        return {"type": "text", "text": part}
-    if isinstance(part, dict):
-        return part
-    raise ValueError("Unsupported message content part")
+def _iter_normalized_parts(content: MessageContent) -> Iterator[ContentPart]:
+    """Yield message content as content parts (strings become text parts)"""
+    if isinstance(content, str):
+        yield {"type": "text", "text": content}
+        return
+    for part in content if isinstance(content, list) else (content,):
+        if isinstance(part, str):
+            yield {"type": "text", "text": part}
+        elif isinstance(part, dict):
+            yield part
+        else:
+            raise ValueError("Unsupported message content part")
 
 
-def _normalize_message(message: Message) -> Dict[str, Any]:
+def _normalize_message(message: Message) -> NormalizedMessage:
     """Normalize message for API"""
     role = message.get("role")
     name = message.get("name")
     tool_call_id = message.get("tool_call_id")
     content = message.get("content", "")
     
+    # Fast path: plain-string chat content needs no part normalization
+    if isinstance(content, str) and role not in ("tool", "function"):
+        result = {"role": role, "content": content}
+        if name:
+            result["name"] = name
+        return result
+    
     if role in ("tool", "function"):
-        content_parts = _ensure_array(content)
         content_str = "\n".join(
-            part if isinstance(part, str) else str(part)
-            for part in content_parts
+            part["text"] if part.get("type") == "text" else str(part)
+            for part in _iter_normalized_parts(content)
         )
         result = {
             "role": role,
@@ -59,19 +84,20 @@ def _normalize_message(message: Message) -> Dict[str, Any]:
             result["tool_call_id"] = tool_call_id
         return result
     
-    content_parts = _ensure_array(content)
-    normalized_parts = [_normalize_content_part(part) for part in content_parts]
+    parts = _iter_normalized_parts(content)
+    first = next(parts, None)
+    rest = list(parts)
     
     # If only text content, collapse to string
-    if len(normalized_parts) == 1 and normalized_parts[0].get("type") == "text":
+    if first is not None and not rest and first.get("type") == "text":
         result = {
             "role": role,
-            "content": normalized_parts[0]["text"],
+            "content": first["text"],
         }
     else:
         result = {
             "role": role,
-            "content": normalized_parts,
+            "content": [first, *rest] if first is not None else [],
         }
     
     if name:
@@ -94,19 +120,40 @@ def _assert_api_key():
         raise ValueError("OPENROUTER_API_KEY is not configured")
 
 
+# env is read once at import, so the endpoint and auth header never change
+_API_URL = _resolve_api_url()
+_AUTH_HEADERS = {
+    "content-type": "application/json",
+    "authorization": f"Bearer {env.forge_api_key}",
+}
+
+
 async def invoke_llm(
     messages: List[Message],
     tools: Optional[List[Tool]] = None,
     tool_choice: Optional[Union[str, Dict[str, Any]]] = None,
     max_tokens: Optional[int] = None,
     response_format: Optional[Dict[str, Any]] = None,
+    system_prompt: Optional[str] = None,
+    cached_messages: Optional[List[NormalizedMessage]] = None,
 ) -> InvokeResult:
-    """Invoke LLM API"""
+    """Invoke LLM API
+    
+    `system_prompt` and `cached_messages` (already normalized, e.g. built once
+    at import) are prepended to `messages` without re-normalizing them.
+    """
     _assert_api_key()
     
+    normalized: List[NormalizedMessage] = []
+    if system_prompt:
+        normalized.append({"role": "system", "content": system_prompt})
+    if cached_messages:
+        normalized.extend(cached_messages)
+    normalized.extend(map(_normalize_message, messages))
+    
     payload: Dict[str, Any] = {
         "model": "openai/gpt-5-mini",
-        "messages": [_normalize_message(msg) for msg in messages],
+        "messages": normalized,
     }
     
     if tools and len(tools) > 0:
@@ -120,23 +167,18 @@ async def invoke_llm(
     if response_format:
         payload["response_format"] = response_format
     
-    import httpx
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            _resolve_api_url(),
-            headers={
-                "content-type": "application/json",
-                "authorization": f"Bearer {env.forge_api_key}",
-            },
-            json=payload,
-            timeout=60.0,
+    response = await http_client.post(
+        _API_URL,
+        headers=_AUTH_HEADERS,
+        content=orjson.dumps(payload),
+        timeout=60.0,
+    )
+    
+    if not response.is_success:
+        error_text = await response.aread()
+        raise ValueError(
+            f"LLM invoke failed: {response.status_code} {response.reason_phrase} – {error_text.decode()}"
         )
-        
-        if not response.is_success:
-            error_text = await response.aread()
-            raise ValueError(
-                f"LLM invoke failed: {response.status_code} {response.reason_phrase} – {error_text.decode()}"
-            )
-        
-        return response.json()
+    
+    return orjson.loads(response.content)
 
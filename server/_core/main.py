@@ -1,32 +1,60 @@
 """Main FastAPI application"""
+import logging
 import os
 import socket
+import sys
 from typing import Optional
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from pathlib import Path
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request as StarletteRequest
+import orjson
 from server._core.env import env
+from server._core.http import close_http_client
+from server import file_storage
 from server._core.system_router import router as system_router
 from server.routers import router as app_router
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+# Request/auth tracing from our own modules is debug-only outside production
+logging.getLogger("server").setLevel(logging.WARNING if env.is_production else logging.DEBUG)
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Medical AI X-Ray Analysis API")
 
 # CORS middleware
 # Важно: нельзя использовать allow_origins=["*"] с allow_credentials=True
 # Нужно указать конкретные origins
+ALLOWED_ORIGINS = frozenset({
+    "http://localhost:4000",
+    "http://127.0.0.1:4000",
+    "http://localhost:3000",
+    "http://127.0.0.1:3000",
+    "https://ai.teamidea.ru",
+    "http://ai.teamidea.ru",
+    "http://176.98.234.178:4000",
+})
+
+
+class SetOriginCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware with a set lookup instead of a list scan per request"""
+    
+    def __init__(self, app, **kwargs):
+        super().__init__(app, **kwargs)
+        self._allow_origins_set = frozenset(self.allow_origins)
+    
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.allow_all_origins or origin in self._allow_origins_set:
+            return True
+        return self.allow_origin_regex is not None and self.allow_origin_regex.fullmatch(origin) is not None
+
+
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "http://localhost:4000",
-        "http://127.0.0.1:4000",
-        "http://localhost:3000",
-        "http://127.0.0.1:3000",
-        "https://ai.teamidea.ru",
-        "http://ai.teamidea.ru",
-        "http://176.98.234.178:4000",
-    ],
+    SetOriginCORSMiddleware,
+    allow_origins=sorted(ALLOWED_ORIGINS),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -35,41 +63,57 @@ app.add_middleware(
 
 
 # Request logging middleware
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request as StarletteRequest
-from fastapi.responses import JSONResponse
-import json
+_BODY_METHODS = frozenset({"POST", "PUT", "PATCH"})
+_API_PREFIX = "/api/"
+# Auth bodies carry credentials; never dump them, even at DEBUG
+_SENSITIVE_BODY_PREFIX = "/api/auth/"
+_BINARY_CONTENT_TYPES = ("multipart/", "image/")
+_MAX_LOGGED_BODY_BYTES = 4096
+
 
 class LoggingMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: StarletteRequest, call_next):
-        import json
+        if not logger.isEnabledFor(logging.INFO):
+            return await call_next(request)
         
         path = request.url.path
         method = request.method
         
         # Log request
-        print(f"\n[Request] {method} {path}")
+        logger.info("[Request] %s %s", method, path)
         
-        # Read and log body for POST/PUT/PATCH requests
-        if method in ["POST", "PUT", "PATCH"] and path.startswith("/api/"):
-            try:
-                body = await request.body()
-                if body:
-                    try:
-                        body_json = json.loads(body)
-                        print(f"[Request Body] {json.dumps(body_json, indent=2)}")
-                    except:
-                        print(f"[Request Body] {body.decode('utf-8', errors='ignore')[:200]}")
-                    
-                    # Restore body for subsequent handlers
-                    async def receive():
-                        return {"type": "http.request", "body": body}
-                    request._receive = receive
-            except Exception as e:
-                print(f"[Request] Error reading body: {e}")
+        # Log body size/type for POST/PUT/PATCH requests; full body only at DEBUG
+        if method in _BODY_METHODS and path.startswith(_API_PREFIX):
+            content_length = request.headers.get("content-length", "")
+            content_type = request.headers.get("content-type", "")
+            logger.info("[Request Body] %s bytes, content-type: %s", content_length or "?", content_type)
+            
+            # Only buffer small, non-binary bodies; image uploads must not be read twice
+            if (
+                logger.isEnabledFor(logging.DEBUG)
+                and content_length.isdigit()
+                and int(content_length) <= _MAX_LOGGED_BODY_BYTES
+                and not content_type.startswith(_BINARY_CONTENT_TYPES)
+                and not path.startswith(_SENSITIVE_BODY_PREFIX)
+            ):
+                try:
+                    body = await request.body()
+                    if body:
+                        try:
+                            body_json = orjson.loads(body)
+                            logger.debug("[Request Body] %s", orjson.dumps(body_json, option=orjson.OPT_INDENT_2).decode())
+                        except orjson.JSONDecodeError:
+                            logger.debug("[Request Body] %s", body.decode('utf-8', errors='ignore')[:200])
+                        
+                        # Restore body for subsequent handlers
+                        async def receive():
+                            return {"type": "http.request", "body": body}
+                        request._receive = receive
+                except Exception as e:
+                    logger.warning("[Request] Error reading body: %s", e)
         
         response = await call_next(request)
-        print(f"[Response] {method} {path} -> {response.status_code}")
+        logger.info("[Response] %s %s -> %s", method, path, response.status_code)
         return response
 
 app.add_middleware(LoggingMiddleware)
@@ -78,22 +122,33 @@ app.add_middleware(LoggingMiddleware)
 # Убрали tRPC middleware - теперь используем простой REST API
 
 
-def is_port_available(port: int) -> bool:
-    """Check if port is available"""
+def _try_bind(port: int) -> int:
+    """Bind a throwaway socket to port (0 = OS-assigned) and return the bound port"""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        try:
-            s.bind(("0.0.0.0", port))
-            return True
-        except OSError:
-            return False
+        # Same option uvicorn sets, so a port in TIME_WAIT counts as free
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", port))
+        return s.getsockname()[1]
+
+
+def find_available_port(preferred_port: int = 3000) -> int:
+    """Return preferred_port if it is free, otherwise a port picked by the OS"""
+    try:
+        return _try_bind(preferred_port)
+    except OSError:
+        return _try_bind(0)
+
 
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """Close the shared outbound HTTP client"""
+    await close_http_client()
 
-def find_available_port(start_port: int = 3000) -> int:
-    """Find available port starting from start_port"""
-    for port in range(start_port, start_port + 20):
-        if is_port_available(port):
-            return port
-    raise RuntimeError(f"No available port found starting from {start_port}")
+
+@app.on_event("shutdown")
+async def shutdown_file_storage():
+    """Close the local storage connection"""
+    await file_storage.close()
 
 
 # Register routers
@@ -103,11 +158,14 @@ app.include_router(app_router)
 # Static files serving (only in production, not in backend-only mode)
 backend_only = os.getenv("BACKEND_ONLY", "").lower() == "true"
 
-if not backend_only:
-    # Check if dist/public exists
-    dist_public = Path(__file__).parent.parent.parent / "dist" / "public"
-    if dist_public.exists():
-        app.mount("/", StaticFiles(directory=str(dist_public), html=True), name="static")
+# Resolved once: the frontend build does not appear or vanish while running
+_DIST_PUBLIC = Path(__file__).resolve().parent.parent.parent / "dist" / "public"
+_INDEX_HTML = _DIST_PUBLIC / "index.html"
+_DIST_EXISTS = _DIST_PUBLIC.exists()
+_INDEX_EXISTS = _INDEX_HTML.exists()
+
+if not backend_only and _DIST_EXISTS:
+    app.mount("/", StaticFiles(directory=str(_DIST_PUBLIC), html=True), name="static")
 
 
 @app.get("/")
@@ -116,9 +174,8 @@ async def root():
     if backend_only:
         return {"message": "Backend API only mode"}
     # In production, static files will be served
-    dist_public = Path(__file__).parent.parent.parent / "dist" / "public" / "index.html"
-    if dist_public.exists():
-        return FileResponse(str(dist_public))
+    if _INDEX_EXISTS:
+        return FileResponse(_INDEX_HTML)
     return {"message": "Frontend not built"}
 
 
@@ -126,15 +183,28 @@ if __name__ == "__main__":
     import uvicorn
     
     preferred_port = int(os.getenv("PORT", "4001"))
-    port = find_available_port(preferred_port)
+    # Production must bind where the proxy expects it; only dev hops to a free port
+    port = preferred_port if env.is_production else find_available_port(preferred_port)
     
     if port != preferred_port:
         print(f"Port {preferred_port} is busy, using port {port} instead")
     
+    # uvicorn[standard] ships uvloop everywhere except Windows, httptools everywhere
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    
+    # reload and workers are mutually exclusive
+    if env.is_production:
+        # Same variable the uvicorn CLI reads for --workers; one per CPU by default
+        mode_options = {"workers": int(os.getenv("WEB_CONCURRENCY") or os.cpu_count() or 1)}
+    else:
+        mode_options = {"reload": True}
+    
     uvicorn.run(
         "server._core.main:app",
         host="0.0.0.0",
         port=port,
-        reload=not env.is_production,
+        loop=loop,
+        http="httptools",
+        **mode_options,
     )
 
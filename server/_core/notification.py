@@ -1,11 +1,16 @@
 """Notification service"""
-from typing import Dict, Any
+import functools
+import logging
+from typing import Dict, Any, Tuple
+import orjson
 from server._core.env import env
-import httpx
+from server._core.http import http_client
 
 TITLE_MAX_LENGTH = 1200
 CONTENT_MAX_LENGTH = 20000
 
+logger = logging.getLogger(__name__)
+
 
 def _validate_payload(title: str, content: str) -> Dict[str, str]:
     """Validate notification payload"""
@@ -30,6 +35,18 @@ def _build_endpoint_url(base_url: str) -> str:
     return f"{normalized_base}webdevtoken.v1.WebDevService/SendNotification"
 
 
+@functools.lru_cache(maxsize=1)
+def _notify_target() -> Tuple[str, Dict[str, str]]:
+    """Endpoint URL and headers, built on first use rather than at import"""
+    headers = {
+        "accept": "application/json",
+        "authorization": f"Bearer {env.forge_api_key}",
+        "content-type": "application/json",
+        "connect-protocol-version": "1",
+    }
+    return _build_endpoint_url(env.forge_api_url), headers
+
+
 async def notify_owner(title: str, content: str) -> bool:
     """Send notification to owner"""
     try:
@@ -43,32 +60,28 @@ async def notify_owner(title: str, content: str) -> bool:
     if not env.forge_api_key:
         raise ValueError("Notification service API key is not configured.")
     
-    endpoint = _build_endpoint_url(env.forge_api_url)
+    endpoint, headers = _notify_target()
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                endpoint,
-                headers={
-                    "accept": "application/json",
-                    "authorization": f"Bearer {env.forge_api_key}",
-                    "content-type": "application/json",
-                    "connect-protocol-version": "1",
-                },
-                json=payload,
-                timeout=30.0,
+        response = await http_client.post(
+            endpoint,
+            headers=headers,
+            content=orjson.dumps(payload),
+            timeout=30.0,
+        )
+        
+        if not response.is_success:
+            detail = await response.aread()
+            logger.warning(
+                "[Notification] Failed to notify owner (%s %s)%s",
+                response.status_code,
+                response.reason_phrase,
+                f": {detail.decode()}" if detail else "",
             )
-            
-            if not response.is_success:
-                detail = await response.aread()
-                print(
-                    f"[Notification] Failed to notify owner ({response.status_code} {response.reason_phrase})"
-                    f"{f': {detail.decode()}' if detail else ''}"
-                )
-                return False
-            
-            return True
+            return False
+        
+        return True
     except Exception as error:
-        print(f"[Notification] Error calling notification service: {error}")
+        logger.warning("[Notification] Error calling notification service: %s", error)
         return False
 
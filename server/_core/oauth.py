@@ -1,8 +1,8 @@
 """OAuth callback routes"""
 from typing import Optional
-from fastapi import APIRouter, Request, Response, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Request, Response, HTTPException, status
 from fastapi.responses import RedirectResponse
-from server._core.sdk import sdk
+from server._core.sdk import sdk, utc_now
 from server._core.const import COOKIE_NAME, ONE_YEAR_MS
 from server._core.cookies import get_session_cookie_options
 import server.db as db_module
@@ -13,6 +13,7 @@ router = APIRouter()
 @router.get("/api/oauth/callback")
 async def oauth_callback(
     request: Request,
+    background_tasks: BackgroundTasks,
     code: Optional[str] = None,
     state: Optional[str] = None
 ):
@@ -33,14 +34,19 @@ async def oauth_callback(
                 detail="openId missing from user info"
             )
         
-        from datetime import datetime
-        await db_module.upsert_user({
+        user_data = {
             "openId": user_info.openId,
             "name": user_info.name,
             "email": user_info.email,
             "loginMethod": user_info.loginMethod or user_info.platform,
-            "lastSignedIn": datetime.utcnow(),
-        })
+            "lastSignedIn": utc_now(),
+        }
+        # New users must exist before their first request; returning users only
+        # get profile/lastSignedIn refreshed, which can happen after the redirect
+        if await db_module.get_user_by_open_id(user_info.openId):
+            background_tasks.add_task(db_module.upsert_user, user_data)
+        else:
+            await db_module.upsert_user(user_data)
         
         session_token = await sdk.create_session_token(
             user_info.openId,
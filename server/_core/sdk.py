@@ -1,11 +1,18 @@
 """SDK for OAuth and JWT authentication"""
 import base64
+import hashlib
+import logging
+import time
 from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 import httpx
-from jose import jwt, JWTError
+import jwt as pyjwt
+import orjson
 from fastapi import Request, HTTPException, status
+from pydantic import BaseModel
+from server._core.cache import TTLCache
 from server._core.env import env
+from server._core.http import http_client
 from server._core.const import AXIOS_TIMEOUT_MS, COOKIE_NAME, ONE_YEAR_MS
 from server._core.types.manus_types import (
     ExchangeTokenRequest,
@@ -19,6 +26,19 @@ from server.models import User
 import server.db as db_module
 
 
+logger = logging.getLogger(__name__)
+
+SESSION_VERIFY_CACHE_TTL_SECONDS = 300
+SESSION_VERIFY_CACHE_MAX_SIZE = 10_000
+LAST_SIGNED_IN_DEBOUNCE_SECONDS = 60
+_SESSION_ALGORITHMS = ["HS256"]
+
+
+def utc_now() -> datetime:
+    """Current time as an aware UTC datetime (for lastSignedIn and similar columns)"""
+    return datetime.now(timezone.utc)
+
+
 class SessionPayload:
     """Session token payload"""
     def __init__(self, open_id: str, app_id: str, name: str):
@@ -27,18 +47,50 @@ class SessionPayload:
         self.name = name
 
 
+# Successfully verified session tokens, keyed by a digest of the cookie; an
+# entry never outlives the token's own exp claim
+_verified_sessions: TTLCache[SessionPayload] = TTLCache(
+    SESSION_VERIFY_CACHE_MAX_SIZE, SESSION_VERIFY_CACHE_TTL_SECONDS
+)
+
+
+# Registered platform markers; a lower bit means higher login-method precedence
+_PLATFORM_BIT = {
+    "REGISTERED_PLATFORM_EMAIL": 1,
+    "REGISTERED_PLATFORM_GOOGLE": 2,
+    "REGISTERED_PLATFORM_APPLE": 4,
+    "REGISTERED_PLATFORM_MICROSOFT": 8,
+    "REGISTERED_PLATFORM_AZURE": 16,
+    "REGISTERED_PLATFORM_GITHUB": 32,
+}
+_LOGIN_METHOD_FOR_BIT = {1: "email", 2: "google", 4: "apple", 8: "microsoft", 16: "microsoft", 32: "github"}
+
+_JSON_HEADERS = {"content-type": "application/json"}
+
+# openId -> monotonic time of the last lastSignedIn write
+_last_signed_in_touch: Dict[str, float] = {}
+
+
 class OAuthService:
     """OAuth service for token exchange and user info"""
     
-    def __init__(self, base_url: str):
-        self.base_url = base_url
-        self.client = httpx.AsyncClient(
-            base_url=base_url,
+    def __init__(self, base_url: str, client: httpx.AsyncClient = http_client):
+        self.base_url = base_url.rstrip("/")
+        self.client = client
+        logger.debug("[OAuth] Initialized with baseURL: %s", base_url)
+        if not base_url:
+            logger.error("[OAuth] OAUTH_SERVER_URL is not configured!")
+    
+    async def post(self, path: str, payload: BaseModel) -> httpx.Response:
+        """POST a request model to the OAuth server and raise on HTTP errors"""
+        response = await self.client.post(
+            f"{self.base_url}{path}",
+            content=payload.model_dump_json(),
+            headers=_JSON_HEADERS,
             timeout=AXIOS_TIMEOUT_MS / 1000,
         )
-        print(f"[OAuth] Initialized with baseURL: {base_url}")
-        if not base_url:
-            print("[OAuth] ERROR: OAUTH_SERVER_URL is not configured!")
+        response.raise_for_status()
+        return response
     
     def _decode_state(self, state: str) -> str:
         """Decode base64 state"""
@@ -54,22 +106,14 @@ class OAuthService:
             redirectUri=redirect_uri,
         )
         
-        response = await self.client.post(
-            "/webdev.v1.WebDevAuthPublicService/ExchangeToken",
-            json=payload.dict(),
-        )
-        response.raise_for_status()
-        return ExchangeTokenResponse(**response.json())
+        response = await self.post("/webdev.v1.WebDevAuthPublicService/ExchangeToken", payload)
+        return ExchangeTokenResponse.model_validate_json(response.content)
     
     async def getUserInfoByToken(self, token: ExchangeTokenResponse) -> GetUserInfoResponse:
         """Get user info by access token"""
         payload = GetUserInfoRequest(accessToken=token.accessToken)
-        response = await self.client.post(
-            "/webdev.v1.WebDevAuthPublicService/GetUserInfo",
-            json=payload.dict(),
-        )
-        response.raise_for_status()
-        return GetUserInfoResponse(**response.json())
+        response = await self.post("/webdev.v1.WebDevAuthPublicService/GetUserInfo", payload)
+        return GetUserInfoResponse.model_validate_json(response.content)
 
 
 class SDKServer:
@@ -77,6 +121,9 @@ class SDKServer:
     
     def __init__(self):
         self.oauth_service = OAuthService(env.oauth_server_url)
+        self._session_secret = env.cookie_secret.encode('utf-8')
+        # Signature-only decoder restricted to HS256; claims are checked in _decode_session_claims
+        self._jws = pyjwt.PyJWS(algorithms=_SESSION_ALGORITHMS)
     
     def _derive_login_method(self, platforms: Any, fallback: Optional[str]) -> Optional[str]:
         """Derive login method from platforms"""
@@ -85,19 +132,19 @@ class SDKServer:
         if not isinstance(platforms, list) or len(platforms) == 0:
             return None
         
-        platform_set = {p for p in platforms if isinstance(p, str)}
-        if "REGISTERED_PLATFORM_EMAIL" in platform_set:
-            return "email"
-        if "REGISTERED_PLATFORM_GOOGLE" in platform_set:
-            return "google"
-        if "REGISTERED_PLATFORM_APPLE" in platform_set:
-            return "apple"
-        if "REGISTERED_PLATFORM_MICROSOFT" in platform_set or "REGISTERED_PLATFORM_AZURE" in platform_set:
-            return "microsoft"
-        if "REGISTERED_PLATFORM_GITHUB" in platform_set:
-            return "github"
+        # Single pass: OR together the bits of known platforms
+        mask = 0
+        first = None
+        for platform in platforms:
+            if not isinstance(platform, str):
+                continue
+            if first is None:
+                first = platform
+            mask |= _PLATFORM_BIT.get(platform, 0)
         
-        first = next(iter(platform_set), None)
+        if mask:
+            # Lowest set bit is the highest-precedence platform
+            return _LOGIN_METHOD_FOR_BIT[mask & -mask]
         return first.lower() if first else None
     
     async def exchange_code_for_token(self, code: str, state: str) -> ExchangeTokenResponse:
@@ -109,22 +156,16 @@ class SDKServer:
         token_response = ExchangeTokenResponse(accessToken=access_token, tokenType="", expiresIn=0, scope="", idToken="")
         data = await self.oauth_service.getUserInfoByToken(token_response)
         
-        # Extract platforms from response if available
-        platforms = getattr(data, 'platforms', None) if hasattr(data, 'platforms') else None
-        platform = data.platform or getattr(data, 'platform', None)
-        
-        login_method = self._derive_login_method(platforms, platform)
-        
-        # Create response with login method
-        response_dict = data.dict()
-        response_dict['platform'] = login_method
-        response_dict['loginMethod'] = login_method
+        # Extract platforms from response if available (not a declared field)
+        platforms = getattr(data, 'platforms', None)
+        login_method = self._derive_login_method(platforms, data.platform)
         
-        return GetUserInfoResponse(**response_dict)
+        # Copy with login method; fields are already validated
+        return data.model_copy(update={'platform': login_method, 'loginMethod': login_method})
     
     def _get_session_secret(self) -> bytes:
         """Get session secret for JWT"""
-        return env.cookie_secret.encode('utf-8')
+        return self._session_secret
     
     async def create_session_token(
         self,
@@ -149,9 +190,9 @@ class SDKServer:
         if options is None:
             options = {}
         
-        issued_at = datetime.utcnow()
-        expires_in_ms = options.get("expiresInMs", ONE_YEAR_MS)
-        expiration = issued_at + timedelta(milliseconds=expires_in_ms)
+        # Registered time claims are plain epoch seconds
+        issued_at = int(time.time())
+        expiration = issued_at + int(options.get("expiresInMs", ONE_YEAR_MS)) // 1000
         secret_key = self._get_session_secret()
         
         token_data = {
@@ -162,24 +203,47 @@ class SDKServer:
             "iat": issued_at,
         }
         
-        return jwt.encode(token_data, secret_key, algorithm="HS256")
+        return pyjwt.encode(token_data, secret_key, algorithm=_SESSION_ALGORITHMS[0])
+    
+    def _decode_session_claims(self, token: str) -> Dict[str, Any]:
+        """Check the HS256 signature with the bound JWS and validate the claims we rely on"""
+        claims = orjson.loads(
+            self._jws.decode(token, key=self._session_secret, algorithms=_SESSION_ALGORITHMS)
+        )
+        if not isinstance(claims, dict):
+            raise pyjwt.DecodeError("Invalid payload string: must be a json object")
+        
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)):
+            raise pyjwt.MissingRequiredClaimError("exp")
+        if exp <= time.time():
+            raise pyjwt.ExpiredSignatureError("Signature has expired")
+        if "iat" in claims and not isinstance(claims["iat"], (int, float)):
+            raise pyjwt.InvalidIssuedAtError("Issued At claim (iat) must be an integer.")
+        if "openId" not in claims:
+            raise pyjwt.MissingRequiredClaimError("openId")
+        return claims
     
     async def verify_session(self, cookie_value: Optional[str]) -> Optional[SessionPayload]:
         """Verify session cookie"""
         if not cookie_value:
-            print("[Auth] Missing session cookie")
+            logger.debug("[Auth] Missing session cookie")
             return None
         
+        cache_key = hashlib.blake2b(cookie_value.encode("utf-8"), digest_size=16).digest()
+        cached = _verified_sessions.get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
-            secret_key = self._get_session_secret()
-            payload = jwt.decode(cookie_value, secret_key, algorithms=["HS256"])
+            payload = self._decode_session_claims(cookie_value)
             
             open_id = payload.get("openId")
             app_id = payload.get("appId", "")  # appId может быть пустым для простой аутентификации
             name = payload.get("name", "")
             
             if not open_id:
-                print("[Auth] Session payload missing openId")
+                logger.debug("[Auth] Session payload missing openId")
                 return None
             
             # Для простой аутентификации appId может быть пустым
@@ -189,13 +253,25 @@ class SDKServer:
             if not name:
                 name = open_id  # Используем openId как имя, если name не указан
             
-            print(f"[Auth] Session verified: openId={open_id}, appId={app_id or '(empty)'}, name={name}")
+            logger.debug("[Auth] Session verified: openId=%s, appId=%s", open_id, app_id or "(empty)")
             
-            return SessionPayload(open_id, app_id, name)
-        except JWTError as error:
-            print(f"[Auth] Session verification failed: {error}")
+            session = SessionPayload(open_id, app_id, name)
+            exp = payload.get("exp")
+            if isinstance(exp, (int, float)) and exp > time.time():
+                _verified_sessions.set(cache_key, session, ttl=exp - time.time())
+            return session
+        except (pyjwt.PyJWTError, orjson.JSONDecodeError) as error:
+            logger.debug("[Auth] Session verification failed: %s", error)
             return None
     
+    async def verify_request_session(self, request: Request) -> Optional[SessionPayload]:
+        """Verify the request's session cookie once and reuse the payload for the rest of the request"""
+        session = getattr(request.state, "session", None)
+        if session is None:
+            session = await self.verify_session(request.cookies.get(COOKIE_NAME))
+            request.state.session = session
+        return session
+    
     async def get_user_info_with_jwt(self, jwt_token: str) -> GetUserInfoWithJwtResponse:
         """Get user info using JWT token"""
         payload = GetUserInfoWithJwtRequest(
@@ -203,28 +279,30 @@ class SDKServer:
             projectId=env.app_id,
         )
         
-        async with httpx.AsyncClient(timeout=AXIOS_TIMEOUT_MS / 1000) as client:
-            response = await client.post(
-                f"{env.oauth_server_url}/webdev.v1.WebDevAuthPublicService/GetUserInfoWithJwt",
-                json=payload.dict(),
-            )
-            response.raise_for_status()
-            data = response.json()
-            
-            platforms = data.get('platforms')
-            platform = data.get('platform')
-            login_method = self._derive_login_method(platforms, platform)
-            
-            data['platform'] = login_method
-            data['loginMethod'] = login_method
-            
-            return GetUserInfoWithJwtResponse(**data)
+        response = await self.oauth_service.post(
+            "/webdev.v1.WebDevAuthPublicService/GetUserInfoWithJwt", payload
+        )
+        data = orjson.loads(response.content)
+        
+        platforms = data.get('platforms')
+        platform = data.get('platform')
+        login_method = self._derive_login_method(platforms, platform)
+        
+        data['platform'] = login_method
+        data['loginMethod'] = login_method
+        
+        return GetUserInfoWithJwtResponse(**data)
     
     async def authenticate_request(self, request: Request) -> User:
         """Authenticate request and return user"""
-        cookies = request.cookies
-        session_cookie = cookies.get(COOKIE_NAME)
-        session = await self.verify_session(session_cookie)
+        session_cookie = request.cookies.get(COOKIE_NAME)
+        if not session_cookie:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Missing session cookie"
+            )
+        
+        session = await self.verify_request_session(request)
         
         if not session:
             raise HTTPException(
@@ -233,23 +311,22 @@ class SDKServer:
             )
         
         session_user_id = session.openId
-        signed_in_at = datetime.utcnow()
         user = await db_module.get_user_by_open_id(session_user_id)
         
         # If user not in DB, sync from OAuth server
         if not user:
             try:
-                user_info = await self.get_user_info_with_jwt(session_cookie or "")
+                user_info = await self.get_user_info_with_jwt(session_cookie)
                 await db_module.upsert_user({
                     "openId": user_info.openId,
                     "name": user_info.name,
                     "email": user_info.email,
                     "loginMethod": user_info.loginMethod or user_info.platform,
-                    "lastSignedIn": signed_in_at,
+                    "lastSignedIn": utc_now(),
                 })
                 user = await db_module.get_user_by_open_id(user_info.openId)
             except Exception as error:
-                print(f"[Auth] Failed to sync user from OAuth: {error}")
+                logger.warning("[Auth] Failed to sync user from OAuth: %s", error)
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="Failed to sync user info"
@@ -261,11 +338,11 @@ class SDKServer:
                 detail="User not found"
             )
         
-        # Update last signed in
-        await db_module.upsert_user({
-            "openId": user.openId,
-            "lastSignedIn": signed_in_at,
-        })
+        # Update last signed in (at most once per debounce window per user)
+        now = time.monotonic()
+        if now - _last_signed_in_touch.get(user.openId, float("-inf")) >= LAST_SIGNED_IN_DEBOUNCE_SECONDS:
+            await db_module.touch_last_signed_in(user.openId, utc_now())
+            _last_signed_in_touch[user.openId] = now
         
         return user
 
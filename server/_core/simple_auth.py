@@ -1,9 +1,17 @@
 """Simple authentication for MVP - single user, no database"""
+import asyncio
+import hashlib
+import hmac
+import logging
 from typing import Optional
 from datetime import datetime
+import bcrypt
+from server._core.cache import TTLCache
 from server._core.sdk import sdk
 from server._core.const import ONE_YEAR_MS
 
+logger = logging.getLogger(__name__)
+
 # Simple user storage (in-memory for MVP)
 # In production, this would be in a database
 SIMPLE_USERS = {
@@ -12,7 +20,7 @@ SIMPLE_USERS = {
         "openId": "local_example_at_mail.ru",
         "email": "example@mail.ru",
         "name": "example",
-        "passwordHash": "$2b$12$LQv3c1yqBWVHxkd0LHAkCOYz6TtxMQJqhN8/LewY5GyYqJqJqJqJq",  # hash for "123"
+        "passwordHash": "$2b$12$Tyb7cfCNvPhXkVkEznRHK.82uy4g4GXZcDSwcugaoEdHTf.8WW5s.",  # hash for "123"
         "role": "user",
         "loginMethod": "email",
         "createdAt": datetime.utcnow(),
@@ -20,24 +28,54 @@ SIMPLE_USERS = {
     }
 }
 
-# Password: 123
-# To generate: from passlib.context import CryptContext; pwd_context = CryptContext(schemes=["bcrypt"]); print(pwd_context.hash("123"))
-# For now, using a simple check
-VALID_PASSWORDS = {
-    "example@mail.ru": "123"
-}
+# To generate a hash: import bcrypt; print(bcrypt.hashpw(b"123", bcrypt.gensalt()).decode())
+# Plaintext fallback for users without a passwordHash (local development only)
+VALID_PASSWORDS = {}
+
+PASSWORD_CACHE_TTL_SECONDS = 60
+PASSWORD_CACHE_MAX_SIZE = 1024
+
+# (passwordHash, sha256(password)) -> bcrypt result, so repeated attempts with
+# the same credentials skip the deliberately slow hash; raw passwords are never kept
+_password_checks: TTLCache[bool] = TTLCache(PASSWORD_CACHE_MAX_SIZE, PASSWORD_CACHE_TTL_SECONDS)
+
+
+def _bcrypt_check(password: str, password_hash: str) -> bool:
+    """bcrypt comparison (blocking, deliberately slow)"""
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+    except ValueError:
+        # Malformed stored hash
+        return False
 
 
-def verify_simple_password(email: str, password: str) -> bool:
+async def _check_password_hash(password: str, password_hash: str) -> bool:
+    """bcrypt check with a short-lived result cache"""
+    key = (password_hash, hashlib.sha256(password.encode("utf-8")).digest())
+    result = _password_checks.get(key)
+    if result is None:
+        # Only bcrypt runs in a worker thread; the cache is touched on the event loop
+        result = await asyncio.to_thread(_bcrypt_check, password, password_hash)
+        _password_checks.set(key, result)
+    return result
+
+
+async def verify_simple_password(email: str, password: str) -> bool:
     """Verify password for simple auth"""
     # Normalize email: trim whitespace and convert to lowercase
     email = email.strip().lower()
     password = password.strip()
     
-    expected_password = VALID_PASSWORDS.get(email)
-    result = expected_password == password
+    user = SIMPLE_USERS.get(email)
+    if user and user.get("passwordHash"):
+        result = await _check_password_hash(password, user["passwordHash"])
+    else:
+        expected_password = VALID_PASSWORDS.get(email)
+        result = expected_password is not None and hmac.compare_digest(
+            expected_password.encode("utf-8"), password.encode("utf-8")
+        )
     
-    print(f"[SimpleAuth] verify_simple_password: email='{email}', expected='{expected_password}', provided='{password}', match={result}")
+    logger.debug("[SimpleAuth] verify_simple_password: email='%s', match=%s", email, result)
     
     return result
 
@@ -73,8 +111,9 @@ async def create_session_for_user(email: str) -> str:
 
 def get_user_by_open_id(open_id: str) -> Optional[dict]:
     """Get user by openId"""
-    for user in SIMPLE_USERS.values():
-        if user["openId"] == open_id:
-            return user
-    return None
+    return _USERS_BY_OPEN_ID.get(open_id)
+
+
+# Reverse index over SIMPLE_USERS (same dict objects); rebuild if users are added
+_USERS_BY_OPEN_ID = {user["openId"]: user for user in SIMPLE_USERS.values()}
 
@@ -1,6 +1,12 @@
 """Database operations using SQLAlchemy"""
-from typing import Optional, List
-from sqlalchemy import create_engine
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Iterator, Optional, List, TypeVar
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import SQLAlchemyError
 from server.models import (
@@ -9,317 +15,329 @@ from server.models import (
 )
 from server._core.env import env
 
+T = TypeVar("T")
+
 _engine = None
 _SessionLocal = None
-_db: Optional[Session] = None
+_engine_lock = threading.Lock()
 
 
-def get_db() -> Optional[Session]:
-    """Get database session, creating connection if needed"""
-    global _engine, _SessionLocal, _db
-    
+def _get_session_factory() -> Optional[sessionmaker]:
+    """Get session factory, creating the pooled engine if needed"""
     if not env.database_url:
         return None
     
     if _engine is None:
-        try:
-            _engine = create_engine(
-                env.database_url,
-                pool_pre_ping=True,
-                echo=False
-            )
-            _SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
-        except Exception as error:
-            print(f"[Database] Failed to connect: {error}")
-            return None
+        with _engine_lock:
+            if _engine is None:
+                _create_engine()
     
-    if _SessionLocal is None:
-        return None
+    return _SessionLocal
+
+
+def _create_engine() -> None:
+    """Create the pooled engine and session factory (caller holds _engine_lock)"""
+    global _engine, _SessionLocal
     
-    return _SessionLocal()
+    try:
+        # Recycle connections before MySQL's wait_timeout instead of
+        # pinging on every checkout
+        _engine = create_engine(
+            env.database_url,
+            pool_size=20,
+            max_overflow=10,
+            pool_recycle=1800,
+            echo=False
+        )
+        # Objects stay readable after the session is closed
+        _SessionLocal = sessionmaker(
+            autocommit=False, autoflush=False, expire_on_commit=False, bind=_engine
+        )
+    except Exception as error:
+        print(f"[Database] Failed to connect: {error}")
 
 
-async def upsert_user(user_data: dict) -> None:
-    """Insert or update user"""
-    if not user_data.get("openId"):
-        raise ValueError("User openId is required for upsert")
+def get_db() -> Optional[Session]:
+    """Get database session, creating connection if needed"""
+    factory = _get_session_factory()
+    return factory() if factory is not None else None
+
+
+def _in_thread(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Keep the async API but run the blocking SQLAlchemy work in a worker thread"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs) -> T:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def session_scope() -> Iterator[Optional[Session]]:
+    """Session for one unit of work: commit on success, rollback on error, always close
     
+    Yields None when the database is not configured.
+    """
     db = get_db()
-    if not db:
-        print("[Database] Cannot upsert user: database not available")
+    if db is None:
+        yield None
         return
     
     try:
-        existing_user = db.query(User).filter(User.openId == user_data["openId"]).first()
-        
-        if existing_user:
-            # Update existing user
-            for key, value in user_data.items():
-                if key != "openId" and key != "password" and value is not None:
-                    setattr(existing_user, key, value)
-            
-            # Handle password separately (hash it)
-            if "password" in user_data and user_data["password"]:
-                from server._core.password import hash_password
-                existing_user.passwordHash = hash_password(user_data["password"])
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@_in_thread
+def upsert_user(user_data: dict) -> None:
+    """Insert or update user"""
+    if not user_data.get("openId"):
+        raise ValueError("User openId is required for upsert")
+    
+    try:
+        with session_scope() as db:
+            if not db:
+                print("[Database] Cannot upsert user: database not available")
+                return
             
-            # Set role to admin if owner
-            if user_data["openId"] == env.owner_open_id:
-                existing_user.role = UserRole.ADMIN
+            open_id = user_data["openId"]
+            is_owner = open_id == env.owner_open_id
+            changes = {
+                key: value for key, value in user_data.items()
+                if key not in ("openId", "password") and value is not None
+            }
             
-            if not existing_user.lastSignedIn:
-                from datetime import datetime
-                existing_user.lastSignedIn = datetime.utcnow()
-        else:
-            # Create new user
-            role = UserRole.ADMIN if user_data["openId"] == env.owner_open_id else UserRole.USER
+            # Hash password once, before building the statement; skip the
+            # bcrypt work entirely when the stored hash already matches
+            password = user_data.get("password")
+            if password:
+                from server._core.password import hash_password, verify_password
+                current_hash = db.execute(
+                    select(User.passwordHash).where(User.openId == open_id)
+                ).scalar_one_or_none()
+                if not (current_hash and verify_password(password, current_hash)):
+                    changes["passwordHash"] = hash_password(password)
             
-            # Hash password if provided
-            password_hash = None
-            if "password" in user_data and user_data["password"]:
-                from server._core.password import hash_password
-                password_hash = hash_password(user_data["password"])
+            # Owner is always admin; other existing users keep their role
+            if is_owner:
+                changes["role"] = UserRole.ADMIN
             
-            new_user = User(
-                openId=user_data["openId"],
-                name=user_data.get("name"),
-                email=user_data.get("email"),
-                passwordHash=password_hash,
-                loginMethod=user_data.get("loginMethod"),
-                role=role,
+            stmt = mysql_insert(User).values({"role": UserRole.USER, **changes, "openId": open_id})
+            stmt = stmt.on_duplicate_key_update(
+                {**{key: stmt.inserted[key] for key in changes}, "updatedAt": datetime.utcnow()}
             )
-            db.add(new_user)
-        
-        db.commit()
+            db.execute(stmt)
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to upsert user: {error}")
         raise
-    finally:
-        db.close()
 
 
-async def get_user_by_open_id(open_id: str) -> Optional[User]:
+@_in_thread
+def touch_last_signed_in(open_id: str, signed_in_at: datetime) -> None:
+    """Set lastSignedIn for a user with a single UPDATE"""
+    try:
+        with session_scope() as db:
+            if not db:
+                print("[Database] Cannot update user: database not available")
+                return
+            db.execute(
+                update(User).where(User.openId == open_id).values(lastSignedIn=signed_in_at)
+            )
+    except SQLAlchemyError as error:
+        print(f"[Database] Failed to update lastSignedIn: {error}")
+        raise
+
+
+@_in_thread
+def get_user_by_open_id(open_id: str) -> Optional[User]:
     """Get user by openId"""
-    db = get_db()
-    if not db:
-        print("[Database] Cannot get user: database not available")
-        return None
-    
     try:
-        user = db.query(User).filter(User.openId == open_id).first()
-        return user
+        with session_scope() as db:
+            if not db:
+                print("[Database] Cannot get user: database not available")
+                return None
+            return db.execute(select(User).where(User.openId == open_id)).scalar_one_or_none()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get user: {error}")
         return None
-    finally:
-        db.close()
 
 
-async def get_user_by_email(email: str) -> Optional[User]:
+@_in_thread
+def get_user_by_email(email: str) -> Optional[User]:
     """Get user by email"""
-    db = get_db()
-    if not db:
-        print("[Database] Cannot get user: database not available")
-        return None
-    
     try:
-        user = db.query(User).filter(User.email == email).first()
-        return user
+        with session_scope() as db:
+            if not db:
+                print("[Database] Cannot get user: database not available")
+                return None
+            return db.execute(select(User).where(User.email == email)).scalar_one_or_none()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get user by email: {error}")
         return None
-    finally:
-        db.close()
 
 
 # Study operations
-async def create_study(study_data: dict) -> int:
+@_in_thread
+def create_study(study_data: dict) -> int:
     """Create a new study and return its ID"""
-    db = get_db()
-    if not db:
-        raise ValueError("Database not available")
-    
     try:
-        study = Study(
-            userId=study_data["userId"],
-            title=study_data["title"],
-            studyType=StudyType(study_data["studyType"]),
-            status=StudyStatus(study_data.get("status", "draft")),
-        )
-        db.add(study)
-        db.commit()
-        db.refresh(study)
-        return study.id
+        with session_scope() as db:
+            if not db:
+                raise ValueError("Database not available")
+            
+            study = Study(
+                userId=study_data["userId"],
+                title=study_data["title"],
+                studyType=StudyType(study_data["studyType"]),
+                status=StudyStatus(study_data.get("status", "draft")),
+            )
+            db.add(study)
+            db.flush()
+            return study.id
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to create study: {error}")
         raise
-    finally:
-        db.close()
 
 
-async def get_studies_by_user_id(user_id: int) -> List[Study]:
+@_in_thread
+def get_studies_by_user_id(user_id: int) -> List[Study]:
     """Get all studies for a user"""
-    db = get_db()
-    if not db:
-        return []
-    
     try:
-        studies = db.query(Study).filter(Study.userId == user_id).all()
-        return studies
+        with session_scope() as db:
+            if not db:
+                return []
+            return db.scalars(select(Study).where(Study.userId == user_id)).all()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get studies: {error}")
         return []
-    finally:
-        db.close()
 
 
-async def get_study_by_id(study_id: int) -> Optional[Study]:
+@_in_thread
+def get_study_by_id(study_id: int) -> Optional[Study]:
     """Get study by ID"""
-    db = get_db()
-    if not db:
-        return None
-    
     try:
-        study = db.query(Study).filter(Study.id == study_id).first()
-        return study
+        with session_scope() as db:
+            if not db:
+                return None
+            return db.execute(select(Study).where(Study.id == study_id)).scalar_one_or_none()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get study: {error}")
         return None
-    finally:
-        db.close()
 
 
-async def update_study(study_id: int, data: dict) -> None:
+@_in_thread
+def update_study(study_id: int, data: dict) -> None:
     """Update study"""
-    db = get_db()
-    if not db:
-        raise ValueError("Database not available")
-    
     try:
-        study = db.query(Study).filter(Study.id == study_id).first()
-        if not study:
-            raise ValueError(f"Study {study_id} not found")
-        
-        for key, value in data.items():
-            if hasattr(study, key) and value is not None:
-                if key == "studyType":
-                    setattr(study, key, StudyType(value))
-                elif key == "status":
-                    setattr(study, key, StudyStatus(value))
-                else:
-                    setattr(study, key, value)
-        
-        db.commit()
+        with session_scope() as db:
+            if not db:
+                raise ValueError("Database not available")
+            
+            study = db.execute(select(Study).where(Study.id == study_id)).scalar_one_or_none()
+            if not study:
+                raise ValueError(f"Study {study_id} not found")
+            
+            for key, value in data.items():
+                if hasattr(study, key) and value is not None:
+                    if key == "studyType":
+                        setattr(study, key, StudyType(value))
+                    elif key == "status":
+                        setattr(study, key, StudyStatus(value))
+                    else:
+                        setattr(study, key, value)
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to update study: {error}")
         raise
-    finally:
-        db.close()
 
 
-async def delete_study(study_id: int) -> None:
+@_in_thread
+def delete_study(study_id: int) -> None:
     """Delete study"""
-    db = get_db()
-    if not db:
-        raise ValueError("Database not available")
-    
     try:
-        study = db.query(Study).filter(Study.id == study_id).first()
-        if study:
-            db.delete(study)
-            db.commit()
+        with session_scope() as db:
+            if not db:
+                raise ValueError("Database not available")
+            
+            study = db.execute(select(Study).where(Study.id == study_id)).scalar_one_or_none()
+            if study:
+                db.delete(study)
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to delete study: {error}")
         raise
-    finally:
-        db.close()
 
 
 # Study image operations
-async def create_study_image(image_data: dict) -> int:
+@_in_thread
+def create_study_image(image_data: dict) -> int:
     """Create study image and return its ID"""
-    db = get_db()
-    if not db:
-        raise ValueError("Database not available")
-    
     try:
-        image = StudyImage(
-            studyId=image_data["studyId"],
-            fileKey=image_data["fileKey"],
-            url=image_data["url"],
-            filename=image_data["filename"],
-            mimeType=image_data["mimeType"],
-            fileSize=image_data["fileSize"],
-        )
-        db.add(image)
-        db.commit()
-        db.refresh(image)
-        return image.id
+        with session_scope() as db:
+            if not db:
+                raise ValueError("Database not available")
+            
+            image = StudyImage(
+                studyId=image_data["studyId"],
+                fileKey=image_data["fileKey"],
+                url=image_data["url"],
+                filename=image_data["filename"],
+                mimeType=image_data["mimeType"],
+                fileSize=image_data["fileSize"],
+            )
+            db.add(image)
+            db.flush()
+            return image.id
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to create study image: {error}")
         raise
-    finally:
-        db.close()
 
 
-async def get_study_images(study_id: int) -> List[StudyImage]:
+@_in_thread
+def get_study_images(study_id: int) -> List[StudyImage]:
     """Get all images for a study"""
-    db = get_db()
-    if not db:
-        return []
-    
     try:
-        images = db.query(StudyImage).filter(StudyImage.studyId == study_id).all()
-        return images
+        with session_scope() as db:
+            if not db:
+                return []
+            return db.scalars(select(StudyImage).where(StudyImage.studyId == study_id)).all()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get study images: {error}")
         return []
-    finally:
-        db.close()
 
 
 # Chat message operations
-async def create_chat_message(message_data: dict) -> int:
+@_in_thread
+def create_chat_message(message_data: dict) -> int:
     """Create chat message and return its ID"""
-    db = get_db()
-    if not db:
-        raise ValueError("Database not available")
-    
     try:
-        message = ChatMessage(
-            studyId=message_data["studyId"],
-            role=ChatMessageRole(message_data["role"]),
-            content=message_data["content"],
-        )
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        return message.id
+        with session_scope() as db:
+            if not db:
+                raise ValueError("Database not available")
+            
+            message = ChatMessage(
+                studyId=message_data["studyId"],
+                role=ChatMessageRole(message_data["role"]),
+                content=message_data["content"],
+            )
+            db.add(message)
+            db.flush()
+            return message.id
     except SQLAlchemyError as error:
-        db.rollback()
         print(f"[Database] Failed to create chat message: {error}")
         raise
-    finally:
-        db.close()
 
 
-async def get_chat_messages(study_id: int) -> List[ChatMessage]:
+@_in_thread
+def get_chat_messages(study_id: int) -> List[ChatMessage]:
     """Get all chat messages for a study"""
-    db = get_db()
-    if not db:
-        return []
-    
     try:
-        messages = db.query(ChatMessage).filter(ChatMessage.studyId == study_id).all()
-        return messages
+        with session_scope() as db:
+            if not db:
+                return []
+            return db.scalars(select(ChatMessage).where(ChatMessage.studyId == study_id)).all()
     except SQLAlchemyError as error:
         print(f"[Database] Failed to get chat messages: {error}")
         return []
-    finally:
-        db.close()
-
@@ -1,222 +1,388 @@
-"""Простое файловое хранилище для MVP - JSON файлы на диске"""
-import json
-import os
-from typing import List, Optional, Dict, Any
+"""Простое файловое хранилище для MVP - SQLite (WAL) на диске"""
+import asyncio
+import logging
+import shutil
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
 from pathlib import Path
 from datetime import datetime
 
+import aiosqlite
+import orjson
+
+logger = logging.getLogger(__name__)
+
 # Директория для хранения данных
 STORAGE_DIR = Path(__file__).parent.parent / "data"
 STORAGE_DIR.mkdir(exist_ok=True)
 
+DATABASE_FILE = STORAGE_DIR / "storage.sqlite3"
+# Файлы изображений: images/{studyId}/{name}, в базе хранятся только метаданные
+IMAGES_DIR = STORAGE_DIR / "images"
+
+# JSON-файлы прежнего хранилища: импортируются один раз при создании базы
 STUDIES_FILE = STORAGE_DIR / "studies.json"
 IMAGES_FILE = STORAGE_DIR / "images.json"
 MESSAGES_FILE = STORAGE_DIR / "messages.json"
 
-# Инициализация файлов, если их нет
-def _init_files():
-    """Инициализировать файлы хранилища, если их нет"""
-    if not STUDIES_FILE.exists():
-        with open(STUDIES_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
-    if not IMAGES_FILE.exists():
-        with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
-    if not MESSAGES_FILE.exists():
-        with open(MESSAGES_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
-
-_init_files()
-
-
-def _load_studies() -> List[Dict[str, Any]]:
-    """Загрузить все исследования из файла"""
-    try:
-        with open(STUDIES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
-
-
-def _save_studies(studies: List[Dict[str, Any]]):
-    """Сохранить исследования в файл"""
-    with open(STUDIES_FILE, "w", encoding="utf-8") as f:
-        json.dump(studies, f, indent=2, ensure_ascii=False, default=str)
-
-
-def _load_images() -> List[Dict[str, Any]]:
-    """Загрузить все изображения из файла"""
+_LEGACY_TABLES = (
+    (STUDIES_FILE, "studies", ("id", "userId", "title", "studyType", "status", "analysisResult", "createdAt", "updatedAt")),
+    (IMAGES_FILE, "studyImages", ("id", "studyId", "fileKey", "url", "filename", "mimeType", "fileSize", "createdAt")),
+    (MESSAGES_FILE, "chatMessages", ("id", "studyId", "role", "content", "createdAt")),
+)
+
+_SCHEMA = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA busy_timeout=5000;
+
+CREATE TABLE IF NOT EXISTS studies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    userId INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    studyType TEXT NOT NULL,
+    status TEXT NOT NULL,
+    analysisResult TEXT,
+    createdAt TEXT NOT NULL,
+    updatedAt TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS studies_user ON studies(userId);
+
+CREATE TABLE IF NOT EXISTS studyImages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    studyId INTEGER NOT NULL,
+    fileKey TEXT NOT NULL,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    mimeType TEXT NOT NULL,
+    fileSize INTEGER NOT NULL,
+    createdAt TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_study ON studyImages(studyId);
+
+CREATE TABLE IF NOT EXISTS chatMessages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    studyId INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    createdAt TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_study ON chatMessages(studyId, createdAt);
+"""
+
+# Колонки исследования, которые можно менять через update_study
+_STUDY_UPDATABLE_COLUMNS = frozenset({"userId", "title", "studyType", "status", "analysisResult"})
+
+_STUDY_IMAGES_QUERY = "SELECT * FROM studyImages WHERE studyId = ? ORDER BY id"
+# Сортировать по дате создания
+_CHAT_MESSAGES_QUERY = "SELECT * FROM chatMessages WHERE studyId = ? ORDER BY createdAt, id"
+
+_connection: Optional[aiosqlite.Connection] = None
+_read_connection: Optional[aiosqlite.Connection] = None
+_connection_lock = asyncio.Lock()
+# Одно соединение на запись на процесс: записи сериализуются, чтобы транзакции не перемешивались
+_write_lock = asyncio.Lock()
+# Чтение идёт через отдельное read-only соединение (WAL): открытая транзакция записи ему не видна
+_read_lock = asyncio.Lock()
+
+
+async def _get_connection() -> aiosqlite.Connection:
+    """Открыть соединения и создать схему при первом обращении"""
+    global _connection, _read_connection
+    if _connection is None:
+        async with _connection_lock:
+            if _connection is None:
+                connection = await aiosqlite.connect(DATABASE_FILE, isolation_level=None)
+                connection.row_factory = aiosqlite.Row
+                await connection.executescript(_SCHEMA)
+                await _import_legacy_json(connection)
+
+                reader = await aiosqlite.connect(f"{DATABASE_FILE.as_uri()}?mode=ro", uri=True, isolation_level=None)
+                reader.row_factory = aiosqlite.Row
+                await reader.execute("PRAGMA busy_timeout=5000")
+                _read_connection = reader
+                _connection = connection
+    return _connection
+
+
+async def _get_read_connection() -> aiosqlite.Connection:
+    """Read-only соединение: видит только зафиксированные данные"""
+    if _read_connection is None:
+        await _get_connection()
+    return _read_connection
+
+
+def _load_legacy_rows(path: Path) -> List[Dict[str, Any]]:
+    """Загрузить строки из JSON-файла прежнего хранилища"""
     try:
-        with open(IMAGES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
+        return orjson.loads(path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
         return []
 
 
-def _save_images(images: List[Dict[str, Any]]):
-    """Сохранить изображения в файл"""
-    with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(images, f, indent=2, ensure_ascii=False, default=str)
-
+async def _import_legacy_json(connection: aiosqlite.Connection) -> None:
+    """Перенести данные из JSON-файлов один раз, при первом открытии базы"""
+    async with connection.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    if version:
+        return
 
-def _load_messages() -> List[Dict[str, Any]]:
-    """Загрузить все сообщения из файла"""
+    await connection.execute("BEGIN IMMEDIATE")
     try:
-        with open(MESSAGES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
-
-
-def _save_messages(messages: List[Dict[str, Any]]):
-    """Сохранить сообщения в файл"""
-    with open(MESSAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(messages, f, indent=2, ensure_ascii=False, default=str)
+        for path, table, columns in _LEGACY_TABLES:
+            rows = _load_legacy_rows(path)
+            if not rows:
+                continue
+            placeholders = ", ".join("?" for _ in columns)
+            await connection.executemany(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                (tuple(row.get(column) for column in columns) for row in rows),
+            )
+        await connection.execute("PRAGMA user_version = 1")
+    except BaseException:
+        await connection.execute("ROLLBACK")
+        raise
+    await connection.execute("COMMIT")
+
+
+async def close() -> None:
+    """Закрыть соединения с хранилищем"""
+    global _connection, _read_connection
+    if _connection is not None:
+        connection, _connection = _connection, None
+        reader, _read_connection = _read_connection, None
+        await reader.close()
+        await connection.close()
+
+
+@asynccontextmanager
+async def _transaction() -> AsyncIterator[aiosqlite.Connection]:
+    """Транзакция на запись: BEGIN IMMEDIATE, COMMIT или ROLLBACK при ошибке"""
+    connection = await _get_connection()
+    async with _write_lock:
+        await connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            await connection.execute("ROLLBACK")
+            raise
+        await connection.execute("COMMIT")
+
+
+@asynccontextmanager
+async def _snapshot() -> AsyncIterator[aiosqlite.Connection]:
+    """Несколько SELECT из одного снимка базы (read-only соединение)"""
+    connection = await _get_read_connection()
+    async with _read_lock:
+        await connection.execute("BEGIN")
+        try:
+            yield connection
+        finally:
+            await connection.execute("COMMIT")
+
+
+def _now_iso() -> str:
+    """Текущее время UTC в формате ISO, как оно хранится в базе"""
+    return datetime.utcnow().isoformat()
+
+
+async def _fetch_all(
+    query: str, params: tuple, connection: Optional[aiosqlite.Connection] = None
+) -> List[Dict[str, Any]]:
+    """Выполнить SELECT и вернуть строки как словари"""
+    connection = connection or await _get_read_connection()
+    async with connection.execute(query, params) as cursor:
+        return [dict(row) for row in await cursor.fetchall()]
+
+
+async def _fetch_one(
+    query: str, params: tuple, connection: Optional[aiosqlite.Connection] = None
+) -> Optional[Dict[str, Any]]:
+    """Выполнить SELECT и вернуть первую строку как словарь"""
+    connection = connection or await _get_read_connection()
+    async with connection.execute(query, params) as cursor:
+        row = await cursor.fetchone()
+    return dict(row) if row is not None else None
 
 
 # Study operations
 async def get_studies_by_user_id(user_id: int) -> List[Dict[str, Any]]:
     """Получить все исследования пользователя"""
-    studies = _load_studies()
-    return [s for s in studies if s.get("userId") == user_id]
+    return await _fetch_all("SELECT * FROM studies WHERE userId = ? ORDER BY id", (user_id,))
 
 
 async def get_study_by_id(study_id: int) -> Optional[Dict[str, Any]]:
     """Получить исследование по ID"""
-    studies = _load_studies()
-    for study in studies:
-        if study.get("id") == study_id:
-            return study
-    return None
+    return await _fetch_one("SELECT * FROM studies WHERE id = ?", (study_id,))
+
+
+async def get_study_with_images_for_user(
+    study_id: int, user_id: int
+) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """Получить исследование пользователя вместе с изображениями (None, если нет или чужое)"""
+    async with _snapshot() as connection:
+        study = await _fetch_one(
+            "SELECT * FROM studies WHERE id = ? AND userId = ?", (study_id, user_id), connection
+        )
+        if study is None:
+            return None
+        images = await _fetch_all(_STUDY_IMAGES_QUERY, (study_id,), connection)
+    return study, images
+
+
+async def get_study_with_messages_for_user(
+    study_id: int, user_id: int
+) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """Получить исследование пользователя вместе с сообщениями чата (None, если нет или чужое)"""
+    async with _snapshot() as connection:
+        study = await _fetch_one(
+            "SELECT * FROM studies WHERE id = ? AND userId = ?", (study_id, user_id), connection
+        )
+        if study is None:
+            return None
+        messages = await _fetch_all(_CHAT_MESSAGES_QUERY, (study_id,), connection)
+    return study, messages
 
 
 async def create_study(study_data: Dict[str, Any]) -> int:
     """Создать новое исследование"""
-    studies = _load_studies()
-    
-    # Найти максимальный ID
-    max_id = max([s.get("id", 0) for s in studies], default=0)
-    new_id = max_id + 1
-    
-    now = datetime.utcnow().isoformat()
-    new_study = {
-        "id": new_id,
-        "userId": study_data["userId"],
-        "title": study_data["title"],
-        "studyType": study_data["studyType"],
-        "status": study_data.get("status", "draft"),
-        "analysisResult": None,
-        "createdAt": now,
-        "updatedAt": now,
-    }
-    
-    studies.append(new_study)
-    _save_studies(studies)
-    
-    print(f"[FileStorage] Study created: id={new_id}, title={study_data['title']}")
+    now = _now_iso()
+    async with _transaction() as connection:
+        cursor = await connection.execute(
+            "INSERT INTO studies (userId, title, studyType, status, analysisResult, createdAt, updatedAt) "
+            "VALUES (?, ?, ?, ?, NULL, ?, ?)",
+            (
+                study_data["userId"],
+                study_data["title"],
+                study_data["studyType"],
+                study_data.get("status", "draft"),
+                now,
+                now,
+            ),
+        )
+        new_id = cursor.lastrowid
+
+    logger.debug("[FileStorage] Study created: id=%s, title=%s", new_id, study_data["title"])
     return new_id
 
 
 async def update_study(study_id: int, update_data: Dict[str, Any]) -> None:
     """Обновить исследование"""
-    studies = _load_studies()
-    
-    for study in studies:
-        if study.get("id") == study_id:
-            study.update(update_data)
-            study["updatedAt"] = datetime.utcnow().isoformat()
-            _save_studies(studies)
-            print(f"[FileStorage] Study updated: id={study_id}")
+    unknown = update_data.keys() - _STUDY_UPDATABLE_COLUMNS
+    if unknown:
+        raise ValueError(f"Unknown study fields: {', '.join(sorted(unknown))}")
+
+    if not update_data:
+        if await get_study_by_id(study_id) is None:
+            raise ValueError(f"Study with id {study_id} not found")
+        return
+
+    # Строка переписывается (и получает новый updatedAt), только если значения действительно меняются
+    columns = list(update_data)
+    values = [update_data[column] for column in columns]
+    assignments = "".join(f"{column} = ?, " for column in columns)
+    changed = " OR ".join(f"{column} IS NOT ?" for column in columns)
+    params = (*values, _now_iso(), study_id, *values)
+    async with _transaction() as connection:
+        cursor = await connection.execute(
+            f"UPDATE studies SET {assignments}updatedAt = ? WHERE id = ? AND ({changed})",
+            params,
+        )
+        if cursor.rowcount:
+            logger.debug("[FileStorage] Study updated: id=%s", study_id)
             return
-    
-    raise ValueError(f"Study with id {study_id} not found")
+        async with connection.execute("SELECT 1 FROM studies WHERE id = ?", (study_id,)) as cursor:
+            exists = await cursor.fetchone() is not None
+
+    if not exists:
+        raise ValueError(f"Study with id {study_id} not found")
 
 
 async def delete_study(study_id: int) -> None:
     """Удалить исследование"""
-    studies = _load_studies()
-    images = _load_images()
-    messages = _load_messages()
-    
-    # Удалить исследование
-    studies = [s for s in studies if s.get("id") != study_id]
-    _save_studies(studies)
-    
-    # Удалить связанные изображения
-    images = [img for img in images if img.get("studyId") != study_id]
-    _save_images(images)
-    
-    # Удалить связанные сообщения
-    messages = [msg for msg in messages if msg.get("studyId") != study_id]
-    _save_messages(messages)
-    
-    print(f"[FileStorage] Study deleted: id={study_id}")
+    # Исследование и связанные изображения и сообщения удаляются одной транзакцией
+    async with _transaction() as connection:
+        await connection.execute("DELETE FROM studyImages WHERE studyId = ?", (study_id,))
+        await connection.execute("DELETE FROM chatMessages WHERE studyId = ?", (study_id,))
+        await connection.execute("DELETE FROM studies WHERE id = ?", (study_id,))
+
+    await asyncio.to_thread(shutil.rmtree, IMAGES_DIR / str(study_id), True)
+
+    logger.debug("[FileStorage] Study deleted: id=%s", study_id)
 
 
 # Image operations
 async def get_study_images(study_id: int) -> List[Dict[str, Any]]:
     """Получить изображения исследования"""
-    images = _load_images()
-    return [img for img in images if img.get("studyId") == study_id]
+    return await _fetch_all(_STUDY_IMAGES_QUERY, (study_id,))
 
 
 async def create_study_image(image_data: Dict[str, Any]) -> int:
     """Создать запись об изображении"""
-    images = _load_images()
-    
-    # Найти максимальный ID
-    max_id = max([img.get("id", 0) for img in images], default=0)
-    new_id = max_id + 1
-    
-    now = datetime.utcnow().isoformat()
-    new_image = {
-        "id": new_id,
-        "studyId": image_data["studyId"],
-        "fileKey": image_data["fileKey"],
-        "url": image_data["url"],
-        "filename": image_data["filename"],
-        "mimeType": image_data["mimeType"],
-        "fileSize": image_data["fileSize"],
-        "createdAt": now,
-    }
-    
-    images.append(new_image)
-    _save_images(images)
-    
-    print(f"[FileStorage] Image created: id={new_id}, studyId={image_data['studyId']}")
+    now = _now_iso()
+    async with _transaction() as connection:
+        cursor = await connection.execute(
+            "INSERT INTO studyImages (studyId, fileKey, url, filename, mimeType, fileSize, createdAt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                image_data["studyId"],
+                image_data["fileKey"],
+                image_data["url"],
+                image_data["filename"],
+                image_data["mimeType"],
+                image_data["fileSize"],
+                now,
+            ),
+        )
+        new_id = cursor.lastrowid
+
+    logger.debug("[FileStorage] Image created: id=%s, studyId=%s", new_id, image_data["studyId"])
     return new_id
 
 
+def _is_safe_file_name(name: str) -> bool:
+    """Имя приходит из URL: не пускаем разделители пути и скрытые файлы"""
+    return bool(name) and "/" not in name and "\\" not in name and not name.startswith(".")
+
+
+def image_file_path(study_id: int, name: str) -> Optional[Path]:
+    """Путь к сохранённому файлу изображения или None, если файла нет"""
+    if not _is_safe_file_name(name):
+        return None
+    path = IMAGES_DIR / str(study_id) / name
+    return path if path.is_file() else None
+
+
+async def save_image_file(study_id: int, name: str, data: bytes) -> None:
+    """Сохранить байты изображения на диск"""
+    if not _is_safe_file_name(name):
+        raise ValueError(f"Invalid image file name: {name!r}")
+    path = IMAGES_DIR / str(study_id) / name
+
+    def write() -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    await asyncio.to_thread(write)
+
+
 # Message operations
 async def get_chat_messages(study_id: int) -> List[Dict[str, Any]]:
     """Получить сообщения чата исследования"""
-    messages = _load_messages()
-    study_messages = [msg for msg in messages if msg.get("studyId") == study_id]
-    # Сортировать по дате создания
-    study_messages.sort(key=lambda x: x.get("createdAt", ""))
-    return study_messages
+    return await _fetch_all(_CHAT_MESSAGES_QUERY, (study_id,))
 
 
 async def create_chat_message(message_data: Dict[str, Any]) -> int:
     """Создать сообщение чата"""
-    messages = _load_messages()
-    
-    # Найти максимальный ID
-    max_id = max([msg.get("id", 0) for msg in messages], default=0)
-    new_id = max_id + 1
-    
-    now = datetime.utcnow().isoformat()
-    new_message = {
-        "id": new_id,
-        "studyId": message_data["studyId"],
-        "role": message_data["role"],
-        "content": message_data["content"],
-        "createdAt": now,
-    }
-    
-    messages.append(new_message)
-    _save_messages(messages)
-    
-    print(f"[FileStorage] Message created: id={new_id}, studyId={message_data['studyId']}")
+    now = _now_iso()
+    async with _transaction() as connection:
+        cursor = await connection.execute(
+            "INSERT INTO chatMessages (studyId, role, content, createdAt) VALUES (?, ?, ?, ?)",
+            (message_data["studyId"], message_data["role"], message_data["content"], now),
+        )
+        new_id = cursor.lastrowid
+
+    logger.debug("[FileStorage] Message created: id=%s, studyId=%s", new_id, message_data["studyId"])
     return new_id
 
@@ -1,9 +1,15 @@
 """OpenAI image analysis"""
-from typing import Literal
-from server._core.llm import invoke_llm, Message
+import asyncio
+import functools
+from typing import Awaitable, Callable, Dict, List, Literal, Tuple
+from server._core.cache import TTLCache
+from server._core.llm import invoke_llm, Message, NormalizedMessage
 
 StudyType = Literal["retinal_scan", "optic_nerve", "macular_analysis"]
 
+ANALYSIS_CACHE_MAX_SIZE = 512
+ANALYSIS_CACHE_TTL_SECONDS = 60 * 60
+
 STUDY_TYPE_PROMPTS = {
     "retinal_scan": """Вы - опытный офтальмолог, специализирующийся на анализе рентгеновских снимков сетчатки глаза.
 Проанализируйте предоставленный снимок сетчатки и предоставьте детальное медицинское заключение.
@@ -43,20 +49,64 @@ STUDY_TYPE_PROMPTS = {
 }
 
 
-async def analyze_xray_image(image_url: str, study_type: StudyType) -> str:
+# Built once: the system prompt per study type is already in normalized form
+_SYSTEM_MESSAGES: Dict[str, NormalizedMessage] = {
+    study_type: {"role": "system", "content": prompt}
+    for study_type, prompt in STUDY_TYPE_PROMPTS.items()
+}
+
+_USER_TEXT_PART = {
+    "type": "text",
+    "text": "Пожалуйста, проанализируйте этот рентгеновский снимок глаза и предоставьте детальное медицинское заключение.",
+}
+
+
+# Finished analyses, plus in-flight calls so concurrent duplicates share one LLM request
+_analysis_cache: TTLCache[str] = TTLCache(ANALYSIS_CACHE_MAX_SIZE, ANALYSIS_CACHE_TTL_SECONDS)
+_analysis_in_flight: Dict[Tuple[str, str], "asyncio.Task[str]"] = {}
+
+
+def _on_analysis_done(key: Tuple[str, str], task: "asyncio.Task[str]") -> None:
+    _analysis_in_flight.pop(key, None)
+    if not task.cancelled() and task.exception() is None:
+        _analysis_cache.set(key, task.result())
+
+
+async def analyze_xray_image(
+    image_key: str,
+    load_image_url: Callable[[], Awaitable[str]],
+    study_type: StudyType,
+) -> str:
+    """Analyze X-ray image using LLM (cached per image and study type)
+    
+    `image_key` must identify the image content (e.g. its storage fileKey);
+    `load_image_url` builds the URL sent to the model and is awaited only on a miss.
+    """
+    key = (image_key, study_type)
+    cached = _analysis_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    task = _analysis_in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_analyze_xray_image(load_image_url, study_type))
+        _analysis_in_flight[key] = task
+        task.add_done_callback(functools.partial(_on_analysis_done, key))
+    # A disconnecting caller must not cancel the call others are waiting on
+    return await asyncio.shield(task)
+
+
+async def _analyze_xray_image(load_image_url: Callable[[], Awaitable[str]], study_type: StudyType) -> str:
     """Analyze X-ray image using LLM"""
-    system_prompt = STUDY_TYPE_PROMPTS[study_type]
+    system_message = _SYSTEM_MESSAGES[study_type]
     
     try:
+        image_url = await load_image_url()
         messages: List[Message] = [
-            {"role": "system", "content": system_prompt},
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "text",
-                        "text": "Пожалуйста, проанализируйте этот рентгеновский снимок глаза и предоставьте детальное медицинское заключение.",
-                    },
+                    _USER_TEXT_PART,
                     {
                         "type": "image_url",
                         "image_url": {
@@ -68,7 +118,7 @@ async def analyze_xray_image(image_url: str, study_type: StudyType) -> str:
             },
         ]
         
-        response = await invoke_llm(messages)
+        response = await invoke_llm(messages, cached_messages=[system_message])
         
         analysis_result = response.get("choices", [{}])[0].get("message", {}).get("content")
         
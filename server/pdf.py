@@ -1,9 +1,10 @@
 """PDF generation using WeasyPrint"""
-from typing import Optional
-from datetime import datetime
-import tempfile
+import asyncio
+import html
 import os
-from nanoid import generate
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from datetime import datetime
 
 # Try to import WeasyPrint, but don't fail if it's not available
 WEASYPRINT_AVAILABLE = False
@@ -17,117 +18,147 @@ except (ImportError, OSError):
     HTML = None
 
 
+# WeasyPrint rendering is synchronous and CPU-heavy; keep it off the event loop
+# and cap how many renders run at once
+_pdf_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="pdf")
+
+
 STUDY_TYPE_LABELS = {
     "retinal_scan": "Сканирование сетчатки",
     "optic_nerve": "Анализ зрительного нерва",
     "macular_analysis": "Анализ макулярной области",
 }
+# Labels are static, so escape them once
+_STUDY_TYPE_LABELS_HTML = {key: html.escape(label) for key, label in STUDY_TYPE_LABELS.items()}
 
 
-def _generate_html(
-    title: str,
-    study_type: str,
-    created_at: datetime,
-    analysis_result: str,
-    image_url: Optional[str] = None
-) -> str:
-    """Generate HTML for PDF"""
-    study_type_label = STUDY_TYPE_LABELS.get(study_type, study_type)
-    formatted_date = created_at.strftime("%d %B %Y")
-    
-    html = f"""
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-  <meta charset="UTF-8">
-  <title>{title}</title>
+_STYLE = """
   <style>
-    @page {{
+    @page {
       size: A4;
       margin: 2cm;
-    }}
-    body {{
+    }
+    body {
       font-family: 'Arial', sans-serif;
       line-height: 1.6;
       color: #1e293b;
       font-size: 12pt;
-    }}
-    .header {{
+    }
+    .header {
       text-align: center;
       margin-bottom: 30px;
       padding-bottom: 20px;
       border-bottom: 2px solid #2563eb;
-    }}
-    .header h1 {{
+    }
+    .header h1 {
       color: #2563eb;
       margin: 0 0 10px 0;
       font-size: 24pt;
-    }}
-    .header .meta {{
+    }
+    .header .meta {
       color: #64748b;
       font-size: 11pt;
-    }}
-    .image-section {{
+    }
+    .image-section {
       text-align: center;
       margin: 30px 0;
-    }}
-    .image-section img {{
+    }
+    .image-section img {
       max-width: 100%;
       height: auto;
       border: 1px solid #e2e8f0;
       border-radius: 8px;
-    }}
-    .content {{
+    }
+    .content {
       margin-top: 30px;
-    }}
-    .content h2 {{
+    }
+    .content h2 {
       color: #2563eb;
       font-size: 16pt;
       margin-top: 25px;
       margin-bottom: 15px;
-    }}
-    .content p {{
+    }
+    .content p {
       margin: 10px 0;
       text-align: justify;
-    }}
-    .footer {{
+    }
+    .footer {
       margin-top: 50px;
       padding-top: 20px;
       border-top: 1px solid #e2e8f0;
       text-align: center;
       color: #64748b;
       font-size: 10pt;
-    }}
+    }
   </style>
-</head>
-<body>
-  <div class="header">
+"""
+
+_HEAD_TEMPLATE = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+  <meta charset="UTF-8">
+  <title>{title}</title>"""
+
+# Everything between the <title> and the per-study header is static
+_HEAD_TAIL = _STYLE + "</head>\n<body>\n"
+
+_HEADER_TEMPLATE = """  <div class="header">
     <h1>{title}</h1>
     <div class="meta">
       <p><strong>Тип исследования:</strong> {study_type_label}</p>
       <p><strong>Дата:</strong> {formatted_date}</p>
     </div>
   </div>
-  
-  {f'''
-  <div class="image-section">
-    <img src="{image_url}" alt="Рентгеновский снимок" />
-  </div>
-  ''' if image_url else ''}
-  
-  <div class="content">
-    <h2>Результаты анализа</h2>
-    {''.join(f'<p>{para}</p>' for para in analysis_result.split('\\n') if para.strip())}
-  </div>
-  
+"""
+
+_FOOTER = """
   <div class="footer">
     <p>Документ создан автоматически системой Medical AI X-Ray Analysis</p>
   </div>
 </body>
-</html>
-    """.strip()
+</html>"""
+
+
+def _generate_html(
+    title: str,
+    study_type: str,
+    created_at: datetime,
+    analysis_result: str,
+    image_url: Optional[str] = None
+) -> str:
+    """Generate HTML for PDF"""
+    fields = {
+        "title": html.escape(title),
+        "study_type_label": _STUDY_TYPE_LABELS_HTML.get(study_type) or html.escape(study_type),
+        "formatted_date": created_at.strftime("%d %B %Y"),
+    }
+    
+    parts: List[str] = [
+        _HEAD_TEMPLATE.format_map(fields),
+        _HEAD_TAIL,
+        _HEADER_TEMPLATE.format_map(fields),
+    ]
+    
+    if image_url:
+        parts.append(
+            '  <div class="image-section">\n'
+            f'    <img src="{html.escape(image_url)}" alt="Рентгеновский снимок" />\n'
+            "  </div>\n"
+        )
     
-    return html
+    parts.append('  <div class="content">\n    <h2>Результаты анализа</h2>\n')
+    for para in analysis_result.split("\n"):
+        if para.strip():
+            parts.append(f"    <p>{html.escape(para)}</p>\n")
+    parts.append("  </div>\n")
+    parts.append(_FOOTER)
+    
+    return "".join(parts)
+
+
+def _render_pdf(html_content: str) -> bytes:
+    """Render HTML to PDF bytes (blocking)"""
+    return HTML(string=html_content, base_url=".").write_pdf()
 
 
 async def generate_pdf(
@@ -142,25 +173,10 @@ async def generate_pdf(
         raise ValueError("WeasyPrint is not available. Please install required dependencies for PDF generation.")
     
     html_content = _generate_html(title, study_type, created_at, analysis_result, image_url)
-    temp_id = generate()
-    
-    # Use temporary file for HTML
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, encoding='utf-8') as html_file:
-        html_path = html_file.name
-        html_file.write(html_content)
     
     try:
-        # Generate PDF using WeasyPrint
-        pdf_bytes = HTML(filename=html_path).write_pdf()
-        
-        # Clean up
-        os.unlink(html_path)
-        
-        return pdf_bytes
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_pdf_executor, _render_pdf, html_content)
     except Exception as error:
-        # Clean up on error
-        if os.path.exists(html_path):
-            os.unlink(html_path)
         print(f"Error generating PDF: {error}")
         raise ValueError("Failed to generate PDF")
-
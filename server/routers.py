@@ -1,26 +1,117 @@
 """Main API routers"""
-from typing import List, Optional
+import asyncio
+import base64
+import binascii
+import io
+import logging
+from datetime import datetime
+from secrets import token_urlsafe
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
+from urllib.parse import quote
 from pydantic import BaseModel, Field
 # Убрали импорты моделей - теперь используем файловое хранилище
 from server._core.dependencies import get_current_user, require_user
 from server._core.cookies import get_session_cookie_options
 from server._core.const import COOKIE_NAME, ONE_YEAR_MS
+from server._core.llm import invoke_llm
+from server._core.simple_auth import verify_simple_password, get_simple_user, create_session_for_user
 import server.file_storage as db
 # Убрали storage_put - для MVP используем локальное хранилище
 from server.openai import analyze_xray_image
-from server.pdf import generate_pdf
+from server.pdf import STUDY_TYPE_LABELS, generate_pdf
 from server.models import StudyType, StudyStatus, ChatMessageRole
-from nanoid import generate
 
-router = APIRouter()
+# Pillow is only used to shrink images before they go to the LLM; without it they are sent as uploaded
+PIL_AVAILABLE = False
+Image = None
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(default_response_class=ORJSONResponse)
+
+# Raster formats accepted for upload -> stored file suffix. Images are served from our
+# own origin, so anything a browser could run as a document (HTML, SVG) is refused
+_IMAGE_SUFFIXES = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tiff",
+}
+# Body of the plain {"success": true} reply, serialized once
+_SUCCESS_BODY = b'{"success":true}'
+# Images sent to the LLM are re-encoded at this quality; plenty for analysis, far fewer bytes than PNG
+_LLM_JPEG_QUALITY = 85
+
+_CHAT_SYSTEM_PROMPT_TEMPLATE = """Вы - опытный офтальмолог-консультант. Вы помогаете врачам разобраться в результатах исследований.
+
+Текущее исследование:
+Тип: {type_label}
+Название: {title}
+
+Результаты анализа:
+{analysis}
+
+Отвечайте профессионально, используя медицинскую терминологию. Предоставляйте конкретные и полезные рекомендации."""
+
+
+def _stored_image_path(image: Dict[str, Any]) -> Optional[Path]:
+    """File backing an image record; None for legacy records that keep a data URL"""
+    return db.image_file_path(image["studyId"], image["fileKey"].rsplit("/", 1)[-1])
+
+
+def _recompress_jpeg(data: bytes) -> Optional[bytes]:
+    """Re-encode an image as JPEG; None if Pillow can't read it"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=_LLM_JPEG_QUALITY)
+    except (OSError, ValueError) as error:
+        logger.warning("Could not recompress image for analysis: %s", error)
+        return None
+    return buffer.getvalue()
+
+
+def _encode_for_llm(path: Path, mime_type: str) -> Tuple[str, str]:
+    """Read an image and base64-encode it, as JPEG when that is smaller (blocking)"""
+    data = path.read_bytes()
+    if PIL_AVAILABLE and mime_type != "image/jpeg":
+        jpeg = _recompress_jpeg(data)
+        if jpeg is not None and len(jpeg) < len(data):
+            data, mime_type = jpeg, "image/jpeg"
+    return mime_type, base64.b64encode(data).decode('ascii')
+
+
+def _success_response() -> Response:
+    """Pre-serialized {"success": true} reply"""
+    return Response(content=_SUCCESS_BODY, media_type="application/json")
+
+
+async def _image_data_url(image: Dict[str, Any]) -> str:
+    """Image as a data URL, for consumers outside this server (the LLM)"""
+    path = _stored_image_path(image)
+    if path is None:
+        return image["url"]
+    mime_type, encoded = await asyncio.to_thread(_encode_for_llm, path, image["mimeType"])
+    return f"data:{mime_type};base64,{encoded}"
 
 
 # Pydantic models for requests/responses
 class StudyCreateInput(BaseModel):
     title: str = Field(..., min_length=1)
-    studyType: str = Field(..., pattern="^(retinal_scan|optic_nerve|macular_analysis)$")
+    studyType: Literal["retinal_scan", "optic_nerve", "macular_analysis"]
 
 
 class StudyCreateOutput(BaseModel):
@@ -94,8 +185,11 @@ class ChatSendMessageOutput(BaseModel):
 @router.get("/api/auth/me")
 async def auth_me(request: Request, user: Optional[dict] = Depends(get_current_user)):
     """Get current user"""
-    print(f"[Auth] auth.me called, user: {user is not None}, cookies: {list(request.cookies.keys())}")
-    return user or None
+    logger.debug("[Auth] auth.me called, user: %s", user is not None)
+    if not user:
+        return None
+    # Never hand the stored record (and its password hash) to the client
+    return {key: value for key, value in user.items() if key != "passwordHash"}
 
 
 class LoginInput(BaseModel):
@@ -115,20 +209,11 @@ async def auth_login(login_data: LoginInput, request: Request):
     email = login_data.email.strip().lower()
     password = login_data.password.strip()
     
-    print(f"[Auth] Login attempt for email: '{email}'")
-    
-    # Simple authentication (no database for MVP)
-    from server._core.simple_auth import (
-        verify_simple_password,
-        get_simple_user,
-        create_session_for_user
-    )
+    logger.debug("[Auth] Login attempt for email: '%s'", email)
     
     # Verify password
-    print(f"[Auth] Verifying password for email: '{email}'")
-    
-    if not verify_simple_password(email, password):
-        print(f"[Auth] Password verification failed for email: '{email}'")
+    if not await verify_simple_password(email, password):
+        logger.debug("[Auth] Password verification failed for email: '%s'", email)
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Get user
@@ -153,7 +238,7 @@ async def auth_login(login_data: LoginInput, request: Request):
         }
     }
     
-    response_obj = JSONResponse(response_data)
+    response_obj = ORJSONResponse(response_data)
     response_obj.set_cookie(
         COOKIE_NAME,
         session_token,
@@ -161,13 +246,7 @@ async def auth_login(login_data: LoginInput, request: Request):
         **cookie_options
     )
     
-    print(f"[Auth] Cookie set: {COOKIE_NAME}={session_token[:20]}...")
-    print(f"[Auth] Cookie options: {cookie_options}")
-    
-    # Проверяем, что cookie действительно установлен в заголовках
-    set_cookie_header = response_obj.headers.get("set-cookie")
-    print(f"[Auth] Set-Cookie header: {set_cookie_header}")
-    print(f"[Auth] All response headers: {list(response_obj.headers.keys())}")
+    logger.debug("[Auth] Session cookie set for email: '%s', options: %s", email, cookie_options)
     
     return response_obj
 
@@ -176,7 +255,7 @@ async def auth_login(login_data: LoginInput, request: Request):
 async def auth_logout(request: Request):
     """Logout user"""
     cookie_options = get_session_cookie_options(request)
-    response = JSONResponse({"success": True})
+    response = _success_response()
     response.delete_cookie(COOKIE_NAME, **cookie_options)
     return response
 
@@ -186,8 +265,8 @@ async def auth_logout(request: Request):
 async def studies_list(user: dict = Depends(require_user)):
     """Get all studies for user"""
     studies = await db.get_studies_by_user_id(user["id"])
-    # Файловое хранилище возвращает словари, просто возвращаем их
-    return studies
+    # Хранилище возвращает готовые к JSON словари - отдаём их orjson без jsonable_encoder
+    return ORJSONResponse(studies)
 
 
 class StudyGetInput(BaseModel):
@@ -197,17 +276,13 @@ class StudyGetInput(BaseModel):
 @router.get("/api/studies/{study_id}")
 async def studies_get(study_id: int, user: dict = Depends(require_user)):
     """Get study by ID"""
-    study = await db.get_study_by_id(study_id)
-    if not study:
+    found = await db.get_study_with_images_for_user(study_id, user["id"])
+    if not found:
         raise HTTPException(status_code=404, detail="Study not found")
-    if study["userId"] != user["id"]:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    images = await db.get_study_images(study_id)
+    study, images = found
     # Добавляем изображения к исследованию
-    result = study.copy()
-    result["images"] = images
-    return result
+    study["images"] = images
+    return ORJSONResponse(study)
 
 
 @router.post("/api/studies")
@@ -229,31 +304,62 @@ async def studies_upload_image(study_id: int, input_data: StudyUploadImageInput,
     if not study or study["userId"] != user["id"]:
         raise HTTPException(status_code=403, detail="Forbidden")
     
-    # Для MVP используем data URL напрямую (base64)
-    # В production можно сохранять файлы локально или в S3
-    image_url = input_data.imageData  # Используем base64 data URL напрямую
+    suffix = _IMAGE_SUFFIXES.get(input_data.mimeType)
+    if suffix is None:
+        raise HTTPException(status_code=400, detail="Unsupported image type")
+    
+    # Декодируем data URL один раз и храним байты на диске, в метаданных - только путь
+    _, _, encoded = input_data.imageData.rpartition(",")
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raw = b""
+    if not raw:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    
+    name = f"{token_urlsafe(12)}{suffix}"
+    await db.save_image_file(study_id, name, raw)
+    image_url = f"/api/studies/{study_id}/images/{name}"
     
     # Save metadata to file storage
     image_id = await db.create_study_image({
         "studyId": study_id,
-        "fileKey": f"studies/{user['id']}/{study_id}/{generate()}-{input_data.filename}",
-        "url": image_url,  # Используем data URL
+        "fileKey": f"studies/{user['id']}/{study_id}/{name}",
+        "url": image_url,
         "filename": input_data.filename,
         "mimeType": input_data.mimeType,
-        "fileSize": len(input_data.imageData),  # Примерный размер
+        "fileSize": len(raw),
     })
     
     return {"id": image_id, "url": image_url}
 
 
+@router.get("/api/studies/{study_id}/images/{name}")
+async def studies_get_image(study_id: int, name: str, user: dict = Depends(require_user)):
+    """Serve a stored study image"""
+    found = await db.get_study_with_images_for_user(study_id, user["id"])
+    if not found:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    _, images = found
+    
+    # The record's mimeType is authoritative; the file name may have no usable extension
+    image = next((image for image in images if image["fileKey"].rsplit("/", 1)[-1] == name), None)
+    path = db.image_file_path(study_id, name) if image else None
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Records from before the upload allowlist may carry any type; never serve those as-is
+    media_type = image["mimeType"] if image["mimeType"] in _IMAGE_SUFFIXES else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, headers={"X-Content-Type-Options": "nosniff"})
+
+
 @router.post("/api/studies/{study_id}/analyze")
 async def studies_analyze(study_id: int, user: dict = Depends(require_user)):
     """Analyze study images"""
-    study = await db.get_study_by_id(study_id)
-    if not study or study["userId"] != user["id"]:
+    found = await db.get_study_with_images_for_user(study_id, user["id"])
+    if not found:
         raise HTTPException(status_code=403, detail="Forbidden")
+    study, images = found
     
-    images = await db.get_study_images(study_id)
     if len(images) == 0:
         raise HTTPException(status_code=400, detail="No images uploaded")
     
@@ -261,8 +367,12 @@ async def studies_analyze(study_id: int, user: dict = Depends(require_user)):
     await db.update_study(study_id, {"status": "analyzing"})
     
     try:
-        # Analyze the first image
-        analysis_result = await analyze_xray_image(images[0]["url"], study["studyType"])
+        # Analyze the first image. Stored images never change, so the fileKey identifies
+        # the content and the file is only read and encoded on a cache miss
+        image = images[0]
+        analysis_result = await analyze_xray_image(
+            image["fileKey"], lambda: _image_data_url(image), study["studyType"]
+        )
         
         # Update study with results
         await db.update_study(study_id, {
@@ -296,7 +406,7 @@ async def studies_update(study_id: int, input_data: StudyUpdateRequest, user: di
         update_data["analysisResult"] = input_data.analysisResult
     
     await db.update_study(study_id, update_data)
-    return {"success": True}
+    return _success_response()
 
 
 @router.delete("/api/studies/{study_id}")
@@ -307,21 +417,25 @@ async def studies_delete(study_id: int, user: dict = Depends(require_user)):
         raise HTTPException(status_code=403, detail="Forbidden")
     
     await db.delete_study(study_id)
-    return {"success": True}
+    return _success_response()
 
 
 @router.get("/api/studies/{study_id}/pdf")
-async def studies_download_pdf(study_id: int, user: dict = Depends(require_user)):
-    """Download study as PDF"""
-    study = await db.get_study_by_id(study_id)
-    if not study or study["userId"] != user["id"]:
+async def studies_download_pdf(study_id: int, format: str = "pdf", user: dict = Depends(require_user)):
+    """Download study as PDF (`?format=base64` returns the legacy JSON body)"""
+    found = await db.get_study_with_images_for_user(study_id, user["id"])
+    if not found:
         raise HTTPException(status_code=403, detail="Forbidden")
+    study, images = found
     
     if not study.get("analysisResult"):
         raise HTTPException(status_code=400, detail="No analysis result available")
     
-    images = await db.get_study_images(study_id)
-    from datetime import datetime
+    image_url = None
+    if images:
+        # WeasyPrint reads stored images straight from disk
+        image_path = _stored_image_path(images[0])
+        image_url = image_path.as_uri() if image_path else images[0]["url"]
     created_at = datetime.fromisoformat(study["createdAt"].replace("Z", "+00:00"))
     
     pdf_buffer = await generate_pdf(
@@ -329,13 +443,21 @@ async def studies_download_pdf(study_id: int, user: dict = Depends(require_user)
         study_type=study["studyType"],
         created_at=created_at,
         analysis_result=study["analysisResult"],
-        image_url=images[0]["url"] if images else None,
+        image_url=image_url,
+    )
+    filename = f"{study['title']}.pdf"
+    
+    if format == "base64":
+        # Convert to base64 off the event loop; PDFs with an embedded scan run to megabytes
+        base64_pdf = (await asyncio.to_thread(base64.b64encode, pdf_buffer)).decode('utf-8')
+        return {"pdf": base64_pdf, "filename": filename}
+    
+    # Raw bytes: no base64 pass, and the body is sent as-is with a Content-Length
+    return Response(
+        content=pdf_buffer,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"},
     )
-    
-    # Convert to base64
-    import base64
-    base64_pdf = base64.b64encode(pdf_buffer).decode('utf-8')
-    return {"pdf": base64_pdf, "filename": f"{study['title']}.pdf"}
 
 
 # Chat endpoints
@@ -346,49 +468,39 @@ class ChatGetMessagesInput(BaseModel):
 @router.get("/api/studies/{study_id}/messages")
 async def studies_get_chat_messages(study_id: int, user: dict = Depends(require_user)):
     """Get chat messages for study"""
-    study = await db.get_study_by_id(study_id)
-    if not study or study["userId"] != user["id"]:
+    found = await db.get_study_with_messages_for_user(study_id, user["id"])
+    if not found:
         raise HTTPException(status_code=403, detail="Forbidden")
-    
-    messages = await db.get_chat_messages(study_id)
-    # Файловое хранилище возвращает словари, просто возвращаем их
-    return messages
+    _, messages = found
+    # Хранилище возвращает готовые к JSON словари - отдаём их orjson без jsonable_encoder
+    return ORJSONResponse(messages)
 
 
 @router.post("/api/studies/{study_id}/messages")
 async def studies_send_chat_message(study_id: int, input_data: ChatSendMessageInput, user: dict = Depends(require_user)):
     """Send chat message"""
-    study = await db.get_study_by_id(study_id)
-    if not study or study["userId"] != user["id"]:
+    found = await db.get_study_with_messages_for_user(study_id, user["id"])
+    if not found:
         raise HTTPException(status_code=403, detail="Forbidden")
+    study, earlier_messages = found
     
-    # Save user message
-    await db.create_chat_message({
+    # Save user message; the write runs while the LLM call is in flight
+    user_message = {
         "studyId": study_id,
         "role": "user",
         "content": input_data.message,
-    })
-    
-    # Prepare context for AI
-    study_type_labels = {
-        "retinal_scan": "Сканирование сетчатки",
-        "optic_nerve": "Анализ зрительного нерва",
-        "macular_analysis": "Анализ макулярной области",
     }
+    user_save = asyncio.create_task(db.create_chat_message(user_message))
     
-    system_prompt = f"""Вы - опытный офтальмолог-консультант. Вы помогаете врачам разобраться в результатах исследований.
-
-Текущее исследование:
-Тип: {study_type_labels.get(study["studyType"], study["studyType"])}
-Название: {study["title"]}
-
-Результаты анализа:
-{study.get("analysisResult") or "Анализ еще не завершен"}
-
-Отвечайте профессионально, используя медицинскую терминологию. Предоставляйте конкретные и полезные рекомендации."""
+    # Prepare context for AI
+    system_prompt = _CHAT_SYSTEM_PROMPT_TEMPLATE.format_map({
+        "type_label": STUDY_TYPE_LABELS.get(study["studyType"], study["studyType"]),
+        "title": study["title"],
+        "analysis": study.get("analysisResult") or "Анализ еще не завершен",
+    })
     
-    # Get chat history
-    chat_history = await db.get_chat_messages(study_id)
+    # Chat history: messages loaded with the study plus the one being saved
+    chat_history = [*earlier_messages, user_message]
     messages = [
         {"role": "system", "content": system_prompt},
         *[
@@ -399,22 +511,23 @@ async def studies_send_chat_message(study_id: int, input_data: ChatSendMessageIn
     
     try:
         # Call LLM
-        from server._core.llm import invoke_llm
         result = await invoke_llm(messages=messages)
         ai_response = result.get("choices", [{}])[0].get("message", {}).get("content")
         
         if not ai_response or not isinstance(ai_response, str):
             raise ValueError("No response from AI")
         
-        # Save AI response
-        await db.create_chat_message({
+        # Save AI response (the user message write has long finished by now)
+        await asyncio.gather(user_save, db.create_chat_message({
             "studyId": study_id,
             "role": "assistant",
             "content": ai_response,
-        })
+        }))
         
         return {"success": True, "message": ai_response}
     except Exception as error:
-        print(f"Error in chat: {error}")
+        logger.warning("Error in chat: %s", error)
+        # Keep the user's message even when the AI call failed
+        await asyncio.gather(user_save, return_exceptions=True)
         raise HTTPException(status_code=500, detail="Failed to get AI response")
 
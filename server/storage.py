@@ -1,23 +1,30 @@
 """Storage operations for file uploads"""
 from typing import Union
-import httpx
+from server._core.cache import TTLCache
 from server._core.env import env
+from server._core.http import http_client
 
+# Shorter than the lifetime of the pre-signed URLs the proxy hands out
+DOWNLOAD_URL_CACHE_TTL_SECONDS = 10 * 60
+DOWNLOAD_URL_CACHE_MAX_SIZE = 4096
 
-def _get_storage_config():
-    """Get storage configuration"""
-    base_url = env.forge_api_url
-    api_key = env.forge_api_key
-    
-    if not base_url or not api_key:
+_download_urls: TTLCache[str] = TTLCache(DOWNLOAD_URL_CACHE_MAX_SIZE, DOWNLOAD_URL_CACHE_TTL_SECONDS)
+
+
+# env is read once at import, so the proxy endpoints and auth header never change
+_BASE_URL = env.forge_api_url.rstrip("/")
+_API_KEY = env.forge_api_key
+_AUTH_HEADERS = {"Authorization": f"Bearer {_API_KEY}"}
+_UPLOAD_URL_PREFIX = f"{_BASE_URL}/v1/storage/upload?path="
+_DOWNLOAD_URL_PREFIX = f"{_BASE_URL}/v1/storage/downloadUrl?path="
+
+
+def _assert_storage_config():
+    """Assert storage proxy credentials are configured"""
+    if not _BASE_URL or not _API_KEY:
         raise ValueError(
             "Storage proxy credentials missing: set BUILT_IN_FORGE_API_URL and BUILT_IN_FORGE_API_KEY"
         )
-    
-    return {
-        "base_url": base_url.rstrip("/"),
-        "api_key": api_key,
-    }
 
 
 def _normalize_key(rel_key: str) -> str:
@@ -25,27 +32,22 @@ def _normalize_key(rel_key: str) -> str:
     return rel_key.lstrip("/")
 
 
-def _build_upload_url(base_url: str, rel_key: str) -> str:
-    """Build upload URL"""
-    base = base_url.rstrip("/") + "/"
-    url = f"{base}v1/storage/upload"
-    return f"{url}?path={_normalize_key(rel_key)}"
+def _build_upload_url(key: str) -> str:
+    """Build upload URL for a normalized key"""
+    return _UPLOAD_URL_PREFIX + key
 
 
-async def _build_download_url(base_url: str, rel_key: str, api_key: str) -> str:
-    """Build download URL"""
-    base = base_url.rstrip("/") + "/"
-    url = f"{base}v1/storage/downloadUrl"
-    download_url = f"{url}?path={_normalize_key(rel_key)}"
+async def _build_download_url(key: str) -> str:
+    """Build download URL for a normalized key (cached per key)"""
+    cached = _download_urls.get(key)
+    if cached is not None:
+        return cached
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            download_url,
-            headers={"Authorization": f"Bearer {api_key}"},
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data["url"]
+    response = await http_client.get(_DOWNLOAD_URL_PREFIX + key, headers=_AUTH_HEADERS)
+    response.raise_for_status()
+    signed_url = response.json()["url"]
+    _download_urls.set(key, signed_url)
+    return signed_url
 
 
 async def storage_put(
@@ -54,9 +56,9 @@ async def storage_put(
     content_type: str = "application/octet-stream"
 ) -> dict:
     """Upload file to storage"""
-    config = _get_storage_config()
+    _assert_storage_config()
     key = _normalize_key(rel_key)
-    upload_url = _build_upload_url(config["base_url"], key)
+    upload_url = _build_upload_url(key)
     
     # Prepare file data
     if isinstance(data, str):
@@ -72,27 +74,28 @@ async def storage_put(
         "file": (filename, file_data, content_type)
     }
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            upload_url,
-            headers={"Authorization": f"Bearer {config['api_key']}"},
-            files=files,
+    response = await http_client.post(
+        upload_url,
+        headers=_AUTH_HEADERS,
+        files=files,
+    )
+    
+    if not response.is_success:
+        error_text = await response.aread()
+        raise ValueError(
+            f"Storage upload failed ({response.status_code} {response.reason_phrase}): {error_text.decode()}"
         )
-        
-        if not response.is_success:
-            error_text = await response.aread()
-            raise ValueError(
-                f"Storage upload failed ({response.status_code} {response.reason_phrase}): {error_text.decode()}"
-            )
-        
-        result = response.json()
-        return {"key": key, "url": result["url"]}
+    
+    result = response.json()
+    # The object behind this key changed; don't hand out a URL signed for the old one
+    _download_urls.pop(key)
+    return {"key": key, "url": result["url"]}
 
 
 async def storage_get(rel_key: str) -> dict:
     """Get download URL for file"""
-    config = _get_storage_config()
+    _assert_storage_config()
     key = _normalize_key(rel_key)
-    url = await _build_download_url(config["base_url"], key, config["api_key"])
+    url = await _build_download_url(key)
     return {"key": key, "url": url}
 